@@ -1,24 +1,46 @@
+import bisect
+import collections
+import concurrent.futures
+import copy
+import functools
+import hashlib
+import io
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import shutil
+import sqlite3
+import struct
+import time
+import cv2
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.modules.module import Module
-from torch.autograd import Variable
 
 def get_rmac_region_coordinates(H, W, L):
-    # Almost verbatim from Tolias et al Matlab implementation.
-    # Could be heavily pythonized, but really not worth it...
+    # The grid only depends on (H, W, L), and a corpus has few distinct
+    # resized shapes, so grids are computed once and copied out of the cache
+    return _rmac_region_coordinates(int(H), int(W), int(L)).copy()
+
+
+@functools.lru_cache(maxsize=1024)
+def _rmac_region_coordinates(H, W, L):
+    # Almost verbatim from Tolias et al Matlab implementation, with the grid
+    # of each level and the rounding vectorized.
     # Desired overlap of neighboring regions
     ovr = 0.4
     # Possible regions for the long dimension
     steps = np.array((2, 3, 4, 5, 6, 7), dtype=np.float32)
     w = np.minimum(H, W)
-    
+
     b = (np.maximum(H, W) - w) / (steps - 1)
     # steps(idx) regions for long dimension. The +1 comes from Matlab
     # 1-indexing...
     idx = np.argmin(np.abs(((w**2 - w * b) / w**2) - ovr)) + 1
-    
+
     # Region overplus per dimension
     Wd = 0
     Hd = 0
@@ -26,8 +48,8 @@ def get_rmac_region_coordinates(H, W, L):
         Wd = idx
     elif H > W:
         Hd = idx
-    
-    regions_xywh = []
+
+    regions_xywh = [np.zeros((0, 4))]
     for l in range(1, L+1):
         wl = np.floor(2 * w / (l + 1))
         wl2 = np.floor(wl / 2 - 1)
@@ -43,20 +65,273 @@ def get_rmac_region_coordinates(H, W, L):
         else:
             b = 0
         cenH = np.floor(wl2 + b * np.arange(l - 1 + Hd + 1)) - wl2
-    
-        for i_ in cenH:
-            for j_ in cenW:
-                regions_xywh.append([j_, i_, wl, wl])
-    
+
+        # Rows of cenH, each of them with all of cenW
+        x, y = np.meshgrid(cenW, cenH)
+        level = np.empty((x.size, 4))
+        level[:, 0] = x.ravel()
+        level[:, 1] = y.ravel()
+        level[:, 2:] = wl
+        regions_xywh.append(level)
+
     # Round the regions. Careful with the borders!
-    for i in range(len(regions_xywh)):
-        for j in range(4):
-            regions_xywh[i][j] = int(round(regions_xywh[i][j]))
-        if regions_xywh[i][0] + regions_xywh[i][2] > W:
-            regions_xywh[i][0] -= ((regions_xywh[i][0] + regions_xywh[i][2]) - W)
-        if regions_xywh[i][1] + regions_xywh[i][3] > H:
-            regions_xywh[i][1] -= ((regions_xywh[i][1] + regions_xywh[i][3]) - H)
-    return np.array(regions_xywh).astype(np.float32)
+    regions_xywh = np.rint(np.vstack(regions_xywh))
+    regions_xywh[:, 0] -= np.maximum(regions_xywh[:, 0] + regions_xywh[:, 2] - W, 0)
+    regions_xywh[:, 1] -= np.maximum(regions_xywh[:, 1] + regions_xywh[:, 3] - H, 0)
+    regions_xywh = regions_xywh.astype(np.float32)
+    regions_xywh.flags.writeable = False
+    return regions_xywh
+
+
+def read_jpeg_size(fname):
+    # (height, width) stored in the frame header of a JPEG file, without
+    # decoding it. None if fname is not a JPEG or the header is not found.
+    with open(fname, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+        try:
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xff:
+                    return None
+                while marker[1] == 0xff:
+                    # Fill bytes before the marker
+                    marker = marker[1:] + f.read(1)
+                if marker[1] == 0x01 or 0xd0 <= marker[1] <= 0xd7:
+                    # Markers without a segment
+                    continue
+                if marker[1] in (0xd9, 0xda):
+                    # End of image or start of the entropy coded data
+                    return None
+                length, = struct.unpack('>H', f.read(2))
+                if 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8, 0xcc):
+                    # Start of frame: precision, height, width
+                    _, height, width = struct.unpack('>BHH', f.read(5))
+                    return height, width
+                f.seek(length - 2, 1)
+        except struct.error:
+            return None
+
+
+_reduced_imread_flags = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def imread_reduced(fname, S):
+    # Reads a color image whose largest side is going to be resized to S.
+    # JPEGs are decoded by libjpeg at the smallest of 1/8, 1/4 and 1/2 of
+    # their size (the scaling is done on the DCT coefficients, which skips
+    # most of the decoding work) whose largest side is still at least S.
+    # Returns the image and the size (H, W) of the full resolution image,
+    # which the resize to S must be computed from.
+    size = read_jpeg_size(fname)
+    if size is not None:
+        H, W = size
+        for factor, flag in _reduced_imread_flags:
+            # libjpeg rounds the scaled sizes up
+            reduced = (-(-H // factor), -(-W // factor))
+            if max(reduced) < S:
+                continue
+            im = cv2.imread(fname, flag)
+            if im is not None and im.shape[:2] == reduced:
+                return im, (H, W)
+            if im is not None and im.shape[:2] == reduced[::-1]:
+                # Rotated by opencv according to its EXIF orientation
+                return im, (W, H)
+            break
+    im = cv2.imread(fname)
+    return im, im.shape[:2]
+
+
+# sqlite connections of ArrayCaches inherited by forked processes
+_inherited_connections = []
+
+
+class ArrayCache:
+    def __init__(self, root, dtype=np.uint8, max_bytes=50 * 2**30, shard_bytes=256 * 2**20):
+        # Persistent cache of arrays of a given dtype (resized images, feature
+        # maps), each with an optional JSON serializable meta. Arrays are
+        # appended to shard files, read back through memory maps, and indexed
+        # in a sqlite database. When the shards take more than max_bytes, the
+        # least recently used ones are deleted. Several processes can share
+        # the cache, each of them appends to its own shards, with its own
+        # connection and maps, reopened after a fork.
+        self.root = root
+        self.dtype = np.dtype(dtype)
+        self.max_bytes = max_bytes
+        self.shard_bytes = shard_bytes
+        self._reset()
+
+    def _reset(self):
+        # The connection, maps, shard being written and the hits and uses not
+        # yet written to the database belong to a process
+        self._pid = os.getpid()
+        self._db = None
+        self._maps = collections.OrderedDict()
+        self._shard = None
+        self._shard_size = 0
+        self._hits = 0
+        self._misses = 0
+        self._last_used = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.update(_pid=None, _db=None, _maps=collections.OrderedDict(), _shard=None, _shard_size=0,
+                     _hits=0, _misses=0, _last_used={})
+        return state
+
+    def key(self, fname, *params):
+        # The arrays computed from a file are invalidated when it is modified
+        return "|".join([os.path.abspath(fname), str(os.stat(fname).st_mtime_ns)] + [str(p) for p in params])
+
+    def get(self, key):
+        found = self.lookup(key)
+        return None if found is None else found[0]
+
+    def lookup(self, key):
+        # (array, meta) stored under key, or None. The array is a read-only
+        # view of the shard.
+        db = self._connect()
+        row = db.execute('SELECT shard, offset, shape, meta FROM arrays WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            shard, offset, shape, meta = row
+            shape = json.loads(shape)
+            end = offset + int(np.prod(shape)) * self.dtype.itemsize
+            data = self._map(shard, end)
+            if data is not None:
+                # Hits only take the write lock once per batch
+                self._hits += 1
+                self._last_used[shard] = time.time()
+                self._flush_every(256)
+                return data[offset:end].view(self.dtype).reshape(shape), json.loads(meta)
+            # Its shard was evicted
+            with db:
+                db.execute('DELETE FROM arrays WHERE key = ?', (key,))
+        self._misses += 1
+        self._flush_every(256)
+        return None
+
+    def _flush_every(self, count):
+        if self._hits + self._misses >= count:
+            self.flush()
+
+    def flush(self):
+        # Writes the hits, misses and shard uses counted since the last flush
+        if not (self._hits or self._misses or self._last_used) or self._pid != os.getpid():
+            return
+        db = self._connect()
+        with db:
+            db.executemany('UPDATE shards SET last_used = MAX(last_used, ?) WHERE name = ?',
+                           [(t, shard) for shard, t in self._last_used.items()])
+            db.execute("UPDATE stats SET value = value + ? WHERE name = 'hits'", (self._hits,))
+            db.execute("UPDATE stats SET value = value + ? WHERE name = 'misses'", (self._misses,))
+        self._hits, self._misses, self._last_used = 0, 0, {}
+
+    def put(self, key, array, meta=None):
+        db = self._connect()
+        self.flush()
+        array = np.ascontiguousarray(array, dtype=self.dtype)
+        if self._shard is not None:
+            # The shard being written may have been evicted by another
+            # process, then the next array starts a new one
+            fname = os.path.join(self.root, self._shard)
+            if not os.path.exists(fname) or os.path.getsize(fname) < self._shard_size:
+                self._shard = None
+        if self._shard is None or self._shard_size + array.nbytes > self.shard_bytes:
+            self._shard = "{0}_{1}.bin".format(os.getpid(), time.time_ns())
+            self._shard_size = 0
+        with open(os.path.join(self.root, self._shard), 'ab') as f:
+            # The offset is that of the file, even if it was evicted since
+            offset = f.tell()
+            f.write(array.tobytes())
+            self._shard_size = f.tell()
+        with db:
+            db.execute('INSERT OR REPLACE INTO arrays VALUES (?, ?, ?, ?, ?)',
+                       (key, self._shard, offset, json.dumps(list(array.shape)), json.dumps(meta)))
+            db.execute('INSERT OR REPLACE INTO shards VALUES (?, ?, ?)', (self._shard, self._shard_size, time.time()))
+        self._evict()
+
+    def stats(self):
+        db = self._connect()
+        self.flush()
+        stats = dict(db.execute('SELECT name, value FROM stats').fetchall())
+        stats['arrays'] = db.execute('SELECT COUNT(*) FROM arrays').fetchone()[0]
+        stats['bytes'] = db.execute('SELECT COALESCE(SUM(size), 0) FROM shards').fetchone()[0]
+        return stats
+
+    def _connect(self):
+        if self._pid != os.getpid():
+            # A forked process must not use the connection of its parent
+            # (sqlite forbids it), nor close it, which could checkpoint the
+            # WAL under the parent: it is kept open and never used again
+            if self._db is not None:
+                _inherited_connections.append(self._db)
+            self._reset()
+        if self._db is None:
+            if not os.path.exists(self.root):
+                os.makedirs(self.root)
+            self._db = sqlite3.connect(os.path.join(self.root, 'index.sqlite'), timeout=600)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            with self._db:
+                self._db.execute('CREATE TABLE IF NOT EXISTS arrays (key TEXT PRIMARY KEY, shard TEXT, offset INTEGER, shape TEXT, meta TEXT)')
+                self._db.execute('CREATE TABLE IF NOT EXISTS shards (name TEXT PRIMARY KEY, size INTEGER, last_used REAL)')
+                self._db.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+                self._db.execute("INSERT OR IGNORE INTO stats VALUES ('hits', 0), ('misses', 0)")
+            # The counts of the hits are written when the process exits
+            multiprocessing.util.Finalize(self, self.flush, exitpriority=10)
+        return self._db
+
+    def _map(self, shard, end):
+        # Memory map of a shard covering at least end bytes. Maps of the
+        # shards still being written are reopened when they grow.
+        data = self._maps.pop(shard, None)
+        if data is None or len(data) < end:
+            try:
+                data = np.memmap(os.path.join(self.root, shard), dtype=np.uint8, mode='r')
+            except (IOError, OSError, ValueError):
+                return None
+            if len(data) < end:
+                return None
+        self._maps[shard] = data
+        while len(self._maps) > 64:
+            self._maps.popitem(last=False)
+        return data
+
+    def _evict(self):
+        db = self._connect()
+        total = db.execute('SELECT COALESCE(SUM(size), 0) FROM shards').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for name, size in db.execute('SELECT name, size FROM shards WHERE name != ? ORDER BY last_used', (self._shard,)).fetchall():
+            with db:
+                db.execute('DELETE FROM arrays WHERE shard = ?', (name,))
+                db.execute('DELETE FROM shards WHERE name = ?', (name,))
+            self._maps.pop(name, None)
+            try:
+                os.remove(os.path.join(self.root, name))
+            except OSError:
+                # Already evicted by another process
+                pass
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+
+def get_rmac_regions_for_network(shapes, L):
+    # Regions of a batch of images of shapes [(H, W), ...], packed as
+    # pack_regions_for_network does: image index, then x1 y1 x2 y2 with the
+    # last coordinate included. L == 0 is a single region covering the whole
+    # image (MAC).
+    if L == 0:
+        regions = [np.array([[0, 0, W, H]], dtype=np.float32) for H, W in shapes]
+    else:
+        regions = [_rmac_region_coordinates(int(H), int(W), int(L)) for H, W in shapes]
+    counts = [len(r) for r in regions]
+    R = np.empty((sum(counts), 5), dtype=np.float32)
+    R[:, 0] = np.repeat(np.arange(len(regions)), counts)
+    R[:, 1:] = np.vstack(regions)
+    R[:, 3:] += R[:, 1:3] - 1
+    return R
+
 
 def pack_regions_for_network(all_regions):
     n_regs = np.sum([len(e) for e in all_regions])
@@ -78,6 +353,809 @@ def pack_regions_for_network(all_regions):
     return R
 
 
+def save_array(fname, array):
+    # np.save through a temporary file, so that fname is either complete or
+    # missing when the process dies
+    tmp_fname = fname[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_fname, array)
+    os.replace(tmp_fname, fname)
+
+
+def load_multiscale_features(fnames, block_size=65536):
+    # L2 normalized sum of the features of fnames (one file per scale). The
+    # files are memory-mapped and summed block_size rows at a time into the
+    # output, so that the peak memory is the output plus one block of each
+    # file, instead of all the scales stacked.
+    scales = [np.load(fname, mmap_mode='r') for fname in fnames]
+    features = np.empty(scales[0].shape, dtype=np.float32)
+    for start in range(0, len(features), block_size):
+        block = features[start:start + block_size]
+        block[:] = scales[0][start:start + block_size]
+        for scale in scales[1:]:
+            block += scale[start:start + block_size]
+        block /= np.sqrt((block * block).sum(axis=1))[:, None]
+    return features
+
+
+def top_k(sim, k, block_size=2**28):
+    # Indices of the k largest similarities of each row of sim, by decreasing
+    # similarity: np.argsort(sim, axis=1)[:, ::-1][:, :k] up to the order of
+    # ties. Only the k survivors of argpartition are sorted. Rows are done a
+    # block at a time, whose indices take about block_size bytes, so that wide
+    # matrices (large databases) need little memory on top of sim.
+    n, m = sim.shape
+    k = min(k, m)
+    idx = np.empty((n, k), dtype=np.int64)
+    if k == 0:
+        return idx
+    rows = max(1, block_size // (8 * m))
+    for start in range(0, n, rows):
+        block = sim[start:start + rows]
+        if k < m:
+            top = np.argpartition(block, m - k, axis=1)[:, m - k:]
+            order = np.argsort(-np.take_along_axis(block, top, axis=1), axis=1, kind='stable')
+            idx[start:start + rows] = np.take_along_axis(top, order, axis=1)
+        else:
+            idx[start:start + rows] = np.argsort(-block, axis=1, kind='stable')
+    return idx
+
+
+def _dot(x, y):
+    # x.dot(y.T) by torch, whose GEMMs release the GIL and use the intra-op
+    # threads of the calling thread. Read-only arrays (memory-mapped
+    # descriptor stores) are copied, a tile at a time.
+    dtype = np.result_type(x.dtype, y.dtype)
+    x, y = np.require(x, dtype, 'W'), np.require(y, dtype, 'W')
+    return torch.from_numpy(x).mm(torch.from_numpy(y).t()).numpy()
+
+
+def _merge_top_k(sim, idx, k):
+    # Top k of the concatenated (similarities, indices) of several searches
+    sim, idx = np.hstack(sim), np.hstack(idx)
+    top = top_k(sim, k)
+    return np.take_along_axis(sim, top, axis=1), np.take_along_axis(idx, top, axis=1)
+
+
+def _search_shard(queries, database, k, memory_budget, offset=0, intra_op_threads=None):
+    if intra_op_threads:
+        # Only sets the threads of the GEMMs run by this thread
+        torch.set_num_threads(intra_op_threads)
+    num_queries, n = len(queries), len(database)
+    dtype = np.result_type(queries.dtype, database.dtype)
+    # 4 bytes per similarity, 8 per index of argpartition, and the database
+    # rows of the tile, copied by _dot when they are read-only
+    tile_size = max(1, memory_budget // 12)
+    query_block = int(max(1, min(num_queries, np.sqrt(tile_size))))
+    row_bytes = 12 * query_block + database.shape[1] * dtype.itemsize
+    database_block = int(max(1, memory_budget // row_bytes))
+    similarities = np.empty((num_queries, k), dtype=dtype)
+    indices = np.empty((num_queries, k), dtype=np.int64)
+    for q_start in range(0, num_queries, query_block):
+        q = queries[q_start:q_start + query_block]
+        best_sim, best_idx = None, None
+        for d_start in range(0, n, database_block):
+            sim = _dot(q, database[d_start:d_start + database_block])
+            top = top_k(sim, k, block_size=8 * sim.size)
+            sim, idx = np.take_along_axis(sim, top, axis=1), top + (offset + d_start)
+            if best_sim is not None:
+                # Running top k
+                sim, idx = _merge_top_k((best_sim, sim), (best_idx, idx), k)
+            best_sim, best_idx = sim, idx
+        similarities[q_start:q_start + query_block] = best_sim
+        indices[q_start:q_start + query_block] = best_idx
+    return similarities, indices
+
+
+def search(queries, database, k, memory_budget=2**30, num_threads=1):
+    # k nearest database vectors of each query by dot product, by decreasing
+    # similarity: (similarities, indices), both (#queries, k). Queries and
+    # database are split in tiles whose similarities and top_k indices fit in
+    # memory_budget bytes. Each tile is a single GEMM, and the top k of each
+    # query are merged across the database tiles, so that the memory does
+    # not grow with the database. database may be memory-mapped.
+    # With num_threads > 1 the database is split in num_threads shards,
+    # searched by as many threads, each with its share of memory_budget and
+    # of the intra-op threads, so that the GEMMs do not oversubscribe the
+    # cores. The top k of the shards are then merged.
+    k = min(k, len(database))
+    num_threads = max(1, min(num_threads, len(database)))
+    if num_threads == 1:
+        return _search_shard(queries, database, k, memory_budget)
+    intra_op_threads = max(1, torch.get_num_threads() // num_threads)
+    with concurrent.futures.ThreadPoolExecutor(num_threads) as pool:
+        shards = [pool.submit(_search_shard, queries, database[start:end], min(k, end - start),
+                              memory_budget // num_threads, start, intra_op_threads)
+                  for start, end in shard_ranges(len(database), num_threads)]
+        shards = [shard.result() for shard in shards]
+    return _merge_top_k([sim for sim, _ in shards], [idx for _, idx in shards], k)
+
+
+# Descriptor stores: magic, format version and length of the JSON header
+# (uint32 little endian), the header, the descriptors from data_offset (a
+# multiple of the page size, to memory-map them), then the JSON list of the
+# image ids at ids_offset
+DESCRIPTOR_STORE_MAGIC = b'RMACDESC'
+DESCRIPTOR_STORE_VERSION = 1
+
+
+def save_descriptors(fname, features, ids, block_size=65536, rows=None, **meta):
+    # Writes the descriptors of the images ids (one row each) in a descriptor
+    # store, with meta (S, L, model hash, ...) in its header. Like save_array,
+    # fname is either complete or missing when the process dies. rows only
+    # writes these rows of features, in this order, without copying them all.
+    features = np.asarray(features)
+    count = len(features) if rows is None else len(rows)
+    ids = [str(i) for i in ids]
+    assert len(ids) == count
+    dtype = features.dtype.newbyteorder('<')
+    ids_json = json.dumps(ids).encode('utf-8')
+    header = dict(meta, version=DESCRIPTOR_STORE_VERSION, count=count, dim=int(features.shape[1]),
+                  dtype=dtype.str, data_offset=0, ids_offset=0, ids_bytes=len(ids_json))
+    # The offsets take at most 20 digits each
+    header_size = 16 + len(json.dumps(header).encode('utf-8')) + 40
+    header['data_offset'] = -(-header_size // 4096) * 4096
+    header['ids_offset'] = header['data_offset'] + count * header['dim'] * dtype.itemsize
+    header_json = json.dumps(header).encode('utf-8')
+
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wb') as f:
+        f.write(DESCRIPTOR_STORE_MAGIC + struct.pack('<II', DESCRIPTOR_STORE_VERSION, len(header_json)) + header_json)
+        f.write(b'\0' * (header['data_offset'] - f.tell()))
+        for start in range(0, count, block_size):
+            block = features[start:start + block_size] if rows is None else features[rows[start:start + block_size]]
+            f.write(np.ascontiguousarray(block, dtype=dtype).tobytes())
+        f.write(ids_json)
+    os.replace(tmp_fname, fname)
+
+
+class DescriptorStore:
+    def __init__(self, fname):
+        # Read-only view of a descriptor store. The descriptors are
+        # memory-mapped, so opening a store is immediate whatever its size,
+        # and the processes searching the same store share its pages. The id
+        # table is only read when it is used.
+        self.fname = fname
+        with open(fname, 'rb') as f:
+            magic = f.read(len(DESCRIPTOR_STORE_MAGIC))
+            if magic != DESCRIPTOR_STORE_MAGIC:
+                raise ValueError("{0} is not a descriptor store".format(fname))
+            version, header_size = struct.unpack('<II', f.read(8))
+            if version > DESCRIPTOR_STORE_VERSION:
+                raise ValueError("{0} is a version {1} descriptor store, only versions up to {2} can be read".format(
+                    fname, version, DESCRIPTOR_STORE_VERSION))
+            self.header = json.loads(f.read(header_size).decode('utf-8'))
+        shape = (self.header['count'], self.header['dim'])
+        if self.header['count'] == 0:
+            self.features = np.zeros(shape, dtype=self.header['dtype'])
+        else:
+            self.features = np.memmap(fname, dtype=self.header['dtype'], mode='r', offset=self.header['data_offset'], shape=shape)
+        self._ids = None
+        self._rows = None
+
+    def __len__(self):
+        return self.header['count']
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            with open(self.fname, 'rb') as f:
+                f.seek(self.header['ids_offset'])
+                self._ids = json.loads(f.read(self.header['ids_bytes']).decode('utf-8'))
+        return self._ids
+
+    def row(self, image_id):
+        # Row of the descriptor of an image id
+        if self._rows is None:
+            self._rows = dict((i, r) for r, i in enumerate(self.ids))
+        return self._rows[image_id]
+
+
+def is_current_store(fname, count, **meta):
+    # Whether fname is a descriptor store of count rows saved with meta in
+    # its header (e.g. by the same model), and can be reused
+    if not os.path.exists(fname):
+        return False
+    header = DescriptorStore(fname).header
+    return header['count'] == count and all(header.get(key) == value for key, value in meta.items())
+
+
+def file_hash(fnames):
+    # Short hash of the contents of the existing files of fnames, e.g. to
+    # tell the models descriptors were extracted with apart
+    h = hashlib.sha1()
+    for fname in fnames:
+        if not os.path.exists(fname):
+            continue
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                h.update(block)
+    return h.hexdigest()[:16]
+
+
+def nearest_centroids(x, centroids, spherical=True, memory_budget=2**30):
+    # Index of the centroid of each row of x of largest dot product, or of
+    # smallest Euclidean distance, that of largest x.c - |c|^2 / 2
+    if not spherical:
+        x = np.hstack((x, np.ones((len(x), 1), dtype=x.dtype)))
+        centroids = np.hstack((centroids, -0.5 * (centroids * centroids).sum(axis=1, keepdims=True)))
+    return search(x, centroids, 1, memory_budget)[1][:, 0]
+
+
+def kmeans(x, num_clusters, iterations=10, sample_size=None, seed=0, memory_budget=2**30, spherical=True):
+    # Spherical k-means of the L2 normalized rows of x, which compares them
+    # by dot product like the search: num_clusters L2 normalized centroids.
+    # Trained on sample_size random rows (256 per cluster by default), so x
+    # may be a large memory-mapped array. spherical=False is the Euclidean
+    # k-means, e.g. of the subvectors of product quantization.
+    rng = np.random.RandomState(seed)
+    sample_size = min(len(x), sample_size or 256 * num_clusters)
+    assert num_clusters <= sample_size
+    sample = np.asarray(x[np.sort(rng.choice(len(x), sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(sample_size, num_clusters, replace=False)]
+    for _ in range(iterations):
+        assignment = nearest_centroids(sample, centroids, spherical, memory_budget)
+        sums = torch.zeros(centroids.shape).index_add_(0, torch.from_numpy(assignment), torch.from_numpy(sample)).numpy()
+        counts = np.bincount(assignment, minlength=num_clusters)
+        # Empty clusters restart from random rows
+        empty = np.flatnonzero(counts == 0)
+        sums[empty] = sample[rng.choice(sample_size, len(empty), replace=False)]
+        counts[empty] = 1
+        if spherical:
+            centroids = sums / np.maximum(np.sqrt((sums * sums).sum(axis=1)), 1e-12)[:, None]
+        else:
+            centroids = sums / counts[:, None].astype(np.float32)
+    return centroids
+
+
+def recall_at_k(indices, exact_indices):
+    # Mean fraction of the exact k nearest neighbors of each query found by
+    # an approximate search, whose indices are the same shape
+    return np.mean([len(np.intersect1d(a, b)) / float(len(b)) for a, b in zip(indices, exact_indices)])
+
+
+class IVFIndex:
+    def __init__(self, centroids, list_offsets, vectors, rows):
+        # Inverted file: the database vectors grouped by nearest centroid,
+        # stored contiguously list by list. List l is
+        # vectors[list_offsets[l]:list_offsets[l + 1]], the database rows
+        # rows[list_offsets[l]:list_offsets[l + 1]]. vectors may be
+        # memory-mapped.
+        self.centroids = centroids
+        self.list_offsets = np.asarray(list_offsets, dtype=np.int64)
+        self.vectors = vectors
+        self.rows = np.asarray(rows, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def search(self, queries, k, nprobe=16, memory_budget=2**30):
+        # Approximate k nearest database rows of each query, like search,
+        # comparing the queries only to the vectors of the nprobe lists of
+        # their nearest centroids. Past the vectors of the probed lists, the
+        # similarities are -inf and the indices -1.
+        num_queries = len(queries)
+        nprobe = min(nprobe, len(self.centroids))
+        _, probes = search(queries, self.centroids, nprobe, memory_budget)
+        similarities = np.full((num_queries, k), -np.inf, dtype=np.float32)
+        indices = np.full((num_queries, k), -1, dtype=np.int64)
+        # The queries probing each list, so that each list is read once and
+        # compared to its queries by a GEMM
+        order = np.argsort(probes, axis=None, kind='stable')
+        query_bounds = np.searchsorted(probes.ravel()[order], np.arange(len(self.centroids) + 1))
+        for l in np.flatnonzero(np.diff(query_bounds)):
+            start, end = self.list_offsets[l], self.list_offsets[l + 1]
+            if start == end:
+                continue
+            q = order[query_bounds[l]:query_bounds[l + 1]] // nprobe
+            # Tiled on both sides like search, counting the copies of the
+            # memory-mapped vectors, so that large lists fit memory_budget
+            sim, idx = _search_shard(queries[q], self.vectors[start:end], min(k, end - start), memory_budget)
+            similarities[q], indices[q] = _merge_top_k((similarities[q], sim), (indices[q], self.rows[start + idx]), k)
+        return similarities, indices
+
+
+def build_ivf_index(fname, database, num_lists, iterations=10, sample_size=None, memory_budget=2**30, **meta):
+    # Trains the centroids of an IVFIndex of database, and saves it in
+    # fname, a descriptor store of the vectors in list order whose ids are
+    # their database rows, and the centroids next to it. The vectors are
+    # written by blocks, so database may be larger than the memory.
+    centroids = kmeans(database, num_lists, iterations, sample_size, memory_budget=memory_budget)
+    assignment = nearest_centroids(database, centroids, memory_budget=memory_budget)
+    rows = np.argsort(assignment, kind='stable')
+    list_offsets = np.searchsorted(assignment[rows], np.arange(num_lists + 1))
+    save_array(index_array_fname(fname, 'centroids'), centroids)
+    save_descriptors(fname, database, rows, rows=rows, list_offsets=list_offsets.tolist(), **meta)
+    return load_ivf_index(fname)
+
+
+def index_array_fname(fname, name):
+    # Array saved next to the descriptor store of an index
+    return "{0}_{1}.npy".format(os.path.splitext(fname)[0], name)
+
+
+def load_ivf_index(fname):
+    # IVFIndex saved by build_ivf_index, whose vectors are memory-mapped
+    store = DescriptorStore(fname)
+    return IVFIndex(np.load(index_array_fname(fname, 'centroids')), store.header['list_offsets'], store.features,
+                    np.array(store.ids, dtype=np.int64))
+
+
+class ProductQuantizer:
+    def __init__(self, codebooks, rotation=None):
+        # Codes of M bytes of D-d vectors: the vectors, rotated by the
+        # orthogonal rotation of OPQ if any, are split in M subvectors of
+        # D / M dimensions, each replaced by the index of its nearest
+        # centroid of the codebook of its subspace. codebooks is
+        # (M, 256, D / M), at most 256 centroids per subspace.
+        self.codebooks = codebooks
+        self.rotation = rotation
+
+    def _subvectors(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        if self.rotation is not None:
+            x = x.dot(self.rotation)
+        return x.reshape(len(x), self.codebooks.shape[0], self.codebooks.shape[2])
+
+    def encode(self, x, block_size=65536):
+        codes = np.empty((len(x), self.codebooks.shape[0]), dtype=np.uint8)
+        for start in range(0, len(x), block_size):
+            sub = self._subvectors(x[start:start + block_size])
+            for m, codebook in enumerate(self.codebooks):
+                codes[start:start + block_size, m] = nearest_centroids(sub[:, m], codebook, spherical=False)
+        return codes
+
+    def decode(self, codes):
+        x = self.codebooks[np.arange(self.codebooks.shape[0]), codes].reshape(len(codes), -1)
+        if self.rotation is not None:
+            x = x.dot(self.rotation.T)
+        return x
+
+    def lookup_tables(self, queries):
+        # Dot products of the subvectors of the queries with all the centroids
+        # of their subspace, (M * #centroids, #queries): the similarity of a
+        # query to a code is the sum of the rows m * #centroids + code[m]
+        tables = np.einsum('qmd,mcd->mcq', self._subvectors(queries), self.codebooks)
+        return np.ascontiguousarray(tables).reshape(-1, len(queries))
+
+    def similarities(self, tables, codes):
+        # Asymmetric similarities of the queries of tables to codes, the
+        # queries staying full precision: (#queries, #codes). The rows of the
+        # tables hold all the queries, so that each code gathers contiguous
+        # rows.
+        num_subspaces, num_centroids = self.codebooks.shape[:2]
+        rows = np.ascontiguousarray(np.asarray(codes).T, dtype=np.int32)
+        rows += (np.arange(num_subspaces, dtype=np.int32) * num_centroids)[:, None]
+        sim = np.zeros((len(codes), tables.shape[1]), dtype=np.float32)
+        for m in range(num_subspaces):
+            sim += np.take(tables, rows[m], axis=0)
+        return sim.T
+
+
+def train_product_quantizer(x, num_subspaces, opq_iterations=0, iterations=10, sample_size=65536, seed=0):
+    # Codebooks of 256 centroids per subspace, learned by k-means on a sample
+    # of x. opq_iterations > 0 also learns the rotation of OPQ, alternating
+    # codebooks and the orthogonal rotation that best maps the sample onto
+    # its reconstruction (orthogonal Procrustes).
+    dim = x.shape[1]
+    assert dim % num_subspaces == 0
+    rng = np.random.RandomState(seed)
+    sample = np.asarray(x[np.sort(rng.choice(len(x), min(len(x), sample_size), replace=False))], dtype=np.float32)
+
+    def train_codebooks(rotated, iterations):
+        sub = rotated.reshape(len(rotated), num_subspaces, dim // num_subspaces)
+        # 256 centroids, one per code, unless there are fewer vectors
+        return np.stack([kmeans(np.ascontiguousarray(sub[:, m]), min(256, len(sub)), iterations, len(sub), seed, spherical=False)
+                         for m in range(num_subspaces)])
+
+    rotation = None
+    if opq_iterations > 0:
+        rotation = np.eye(dim, dtype=np.float32)
+        for _ in range(opq_iterations):
+            quantizer = ProductQuantizer(train_codebooks(sample.dot(rotation), 2))
+            reconstruction = quantizer.decode(quantizer.encode(sample.dot(rotation)))
+            u, _, vt = np.linalg.svd(sample.T.dot(reconstruction))
+            rotation = u.dot(vt).astype(np.float32)
+        sample = sample.dot(rotation)
+    return ProductQuantizer(train_codebooks(sample, iterations), rotation)
+
+
+class PQIndex:
+    def __init__(self, quantizer, codes, vectors=None):
+        # Product quantization codes of the database rows. vectors are the
+        # full precision database vectors the candidates are re-ranked with,
+        # typically memory-mapped from their descriptor store, so that only
+        # those of the candidates are read.
+        self.quantizer = quantizer
+        self.codes = codes
+        self.vectors = vectors
+
+    def __len__(self):
+        return len(self.codes)
+
+    def search(self, queries, k, rerank=0, memory_budget=2**30):
+        # Approximate k nearest database rows of each query, like search, by
+        # the asymmetric similarities of the queries to the codes. The rerank
+        # best candidates are then re-ranked by their exact similarities to
+        # the vectors. Past the rerank first, the similarities are the
+        # asymmetric ones.
+        num_queries, n = len(queries), len(self.codes)
+        k = min(k, n)
+        rerank = min(rerank, n) if self.vectors is not None else 0
+        num_candidates = max(k, rerank)
+        tables = self.quantizer.lookup_tables(queries)
+        # 4 bytes per similarity and per table entry, 8 per index of argpartition
+        database_block = max(1, memory_budget // (16 * max(1, num_queries)))
+        similarities, indices = None, None
+        for start in range(0, n, database_block):
+            sim = self.quantizer.similarities(tables, self.codes[start:start + database_block])
+            top = top_k(sim, num_candidates)
+            sim, idx = np.take_along_axis(sim, top, axis=1), top + start
+            if similarities is not None:
+                # Running top candidates
+                sim, idx = _merge_top_k((similarities, sim), (indices, idx), num_candidates)
+            similarities, indices = sim, idx
+        if similarities is None:
+            return np.empty((num_queries, 0), dtype=np.float32), np.empty((num_queries, 0), dtype=np.int64)
+        for i in range(num_queries if rerank else 0):
+            # Sorted rows read the memory-mapped vectors in order
+            candidates = np.sort(indices[i, :rerank])
+            exact = np.asarray(self.vectors[candidates], dtype=np.float32).dot(np.asarray(queries[i], dtype=np.float32))
+            order = np.argsort(-exact, kind='stable')
+            similarities[i, :rerank], indices[i, :rerank] = exact[order], candidates[order]
+        return similarities[:, :k], indices[:, :k]
+
+
+def build_pq_index(fname, database, num_subspaces, opq_iterations=0, iterations=10, sample_size=65536, vectors=None, **meta):
+    # Trains a product quantizer on database and saves the codes of
+    # database in fname, a descriptor store of M bytes per row whose ids are
+    # the database rows, and the codebooks (and rotation) next to it
+    quantizer = train_product_quantizer(database, num_subspaces, opq_iterations, iterations, sample_size)
+    save_array(index_array_fname(fname, 'codebooks'), quantizer.codebooks)
+    if quantizer.rotation is not None:
+        save_array(index_array_fname(fname, 'rotation'), quantizer.rotation)
+    save_descriptors(fname, quantizer.encode(database), range(len(database)), opq=quantizer.rotation is not None, **meta)
+    return load_pq_index(fname, database if vectors is None else vectors)
+
+
+def load_pq_index(fname, vectors=None):
+    # PQIndex saved by build_pq_index, re-ranking with vectors if given
+    store = DescriptorStore(fname)
+    rotation = np.load(index_array_fname(fname, 'rotation')) if store.header['opq'] else None
+    return PQIndex(ProductQuantizer(np.load(index_array_fname(fname, 'codebooks')), rotation), store.features, vectors)
+
+
+def compute_in_chunks(compute, n, out_fname, chunk_size, split=None):
+    # Resumable np.save(out_fname, compute(0, n)). The rows are computed
+    # chunk_size at a time by compute(start, end) and saved in a directory
+    # next to out_fname, along with a manifest of the completed chunks. An
+    # interrupted run resumes after the last of them. Once all the chunks are
+    # done they are copied one at a time into out_fname, memory-mapped, and
+    # the directory is removed. split = {fname: index} saves instead
+    # compute(0, n)[(slice(None),) + index] in each fname, e.g. one file per
+    # scale of features computed together, without the combined array.
+    outputs = split or {out_fname: ()}
+    if n == 0 or chunk_size <= 0:
+        array = compute(0, n)
+        for fname, index in outputs.items():
+            save_array(fname, array[(slice(None),) + index])
+        return
+    chunk_dir = out_fname[:-len('.npy')] + '.chunks'
+    manifest_fname = os.path.join(chunk_dir, 'manifest.json')
+    manifest = {'n': n, 'chunk_size': chunk_size, 'done': []}
+    if os.path.exists(manifest_fname):
+        with open(manifest_fname) as f:
+            previous = json.load(f)
+        # Chunks of a different split cannot be reused
+        if previous['n'] == n and previous['chunk_size'] == chunk_size:
+            manifest = previous
+    if not os.path.exists(chunk_dir):
+        os.makedirs(chunk_dir)
+
+    ranges = [(start, min(start + chunk_size, n)) for start in range(0, n, chunk_size)]
+    chunk_fnames = [os.path.join(chunk_dir, "{0:06d}.npy".format(k)) for k in range(len(ranges))]
+    done = set(manifest['done'])
+    for k, (start, end) in enumerate(ranges):
+        if k in done:
+            continue
+        save_array(chunk_fnames[k], compute(start, end))
+        manifest['done'].append(k)
+        with open(manifest_fname + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_fname + '.tmp', manifest_fname)
+
+    arrays = {}
+    for (start, end), chunk_fname in zip(ranges, chunk_fnames):
+        chunk = np.load(chunk_fname, mmap_mode='r')
+        for fname, index in outputs.items():
+            part = chunk[(slice(None),) + index]
+            if fname not in arrays:
+                arrays[fname] = np.lib.format.open_memmap(fname[:-len('.npy')] + '.tmp.npy', mode='w+', dtype=part.dtype,
+                                                          shape=(n,) + part.shape[1:])
+            arrays[fname][start:end] = part
+    for fname, array in arrays.items():
+        array.flush()
+        os.replace(fname[:-len('.npy')] + '.tmp.npy', fname)
+    shutil.rmtree(chunk_dir)
+
+
+class _NoStage:
+    # Stage of disabled metrics, shared by all of them
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+class _Stage:
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.metrics.cuda_sync and torch.cuda.is_available() and torch.cuda.is_initialized():
+            # Kernels run asynchronously, the stage ends with the last of them
+            torch.cuda.synchronize()
+        self.metrics.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    # Upper bounds of the latency histograms, in seconds
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        # Count, total time and latency histogram of named stages:
+        #     with metrics.stage('decode'):
+        #         im = cv2.imread(fname)
+        # Stages can be nested, the time of a stage includes that of the
+        # stages it contains. While disabled, stage only returns a shared
+        # no-op context manager.
+        self.enabled = False
+        self.cuda_sync = False
+        self.stages = collections.OrderedDict()
+
+    def enable(self, cuda_sync=True):
+        # With cuda_sync, stages wait for the CUDA kernels they launched, so
+        # that their time is not billed to the next stage that synchronizes
+        self.enabled = True
+        self.cuda_sync = cuda_sync
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self, name)
+
+    def record(self, name, seconds):
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = {'count': 0, 'total': 0.0, 'buckets': [0] * (len(self.BUCKETS) + 1)}
+        stats['count'] += 1
+        stats['total'] += seconds
+        stats['buckets'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+
+    def pop(self):
+        # Stats recorded since the last pop, e.g. to send them from a worker
+        # process to merge them in the main one
+        stages, self.stages = self.stages, collections.OrderedDict()
+        return stages
+
+    def merge(self, stages):
+        for name, other in stages.items():
+            stats = self.stages.get(name)
+            if stats is None:
+                self.stages[name] = copy.deepcopy(other)
+                continue
+            stats['count'] += other['count']
+            stats['total'] += other['total']
+            stats['buckets'] = [a + b for a, b in zip(stats['buckets'], other['buckets'])]
+
+    def to_json(self):
+        # Histograms are cumulative, as in Prometheus: the number of calls
+        # that took at most each bound
+        out = collections.OrderedDict()
+        for name, stats in self.stages.items():
+            cumulative = np.cumsum(stats['buckets']).tolist()
+            out[name] = collections.OrderedDict([
+                ('count', stats['count']),
+                ('total_seconds', stats['total']),
+                ('mean_seconds', stats['total'] / max(stats['count'], 1)),
+                ('buckets', collections.OrderedDict([(str(b), c) for b, c in zip(self.BUCKETS + ('+Inf',), cumulative)]))])
+        return json.dumps(out, indent=2)
+
+    def to_prometheus(self, metric='rmac_stage_seconds'):
+        lines = ['# HELP {0} Time spent in each stage of the feature extraction and search.'.format(metric),
+                 '# TYPE {0} histogram'.format(metric)]
+        for name, stats in self.stages.items():
+            for bound, count in zip(self.BUCKETS + ('+Inf',), np.cumsum(stats['buckets']).tolist()):
+                lines.append('{0}_bucket{{stage="{1}",le="{2}"}} {3}'.format(metric, name, bound, count))
+            lines.append('{0}_sum{{stage="{1}"}} {2!r}'.format(metric, name, stats['total']))
+            lines.append('{0}_count{{stage="{1}"}} {2}'.format(metric, name, stats['count']))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, fname, fmt='json'):
+        # fmt is 'json' or 'prometheus' (text exposition format)
+        with open(fname, 'w') as f:
+            f.write(self.to_prometheus() if fmt == 'prometheus' else self.to_json())
+
+
+# Metrics of the process, disabled until enabled by the scripts
+metrics = Metrics()
+
+
+_prefetch_func = None
+
+
+def _prefetch_init(func):
+    global _prefetch_func
+    _prefetch_func = func
+    # Forked workers start with a copy of the metrics of the main process
+    metrics.pop()
+
+
+def _prefetch_call(job):
+    # The metrics of the worker go back with the result
+    result = _prefetch_func(*job)
+    return result, metrics.pop() if metrics.enabled else None
+
+
+def _prefetch_result(pending):
+    result, stages = pending.get()
+    if stages:
+        metrics.merge(stages)
+    return result
+
+
+def prefetch_map(func, jobs, num_workers=0, prefetch=16):
+    # Same as (func(*job) for job in jobs), but func runs in a pool of
+    # num_workers processes and at most prefetch jobs are in flight ahead of
+    # the consumer. Results are yielded in the order of jobs. func is sent to
+    # the workers once, when the pool starts.
+    if num_workers <= 0:
+        for job in jobs:
+            yield func(*job)
+        return
+    pool = multiprocessing.Pool(num_workers, initializer=_prefetch_init, initargs=(func,))
+    try:
+        pending = collections.deque()
+        for job in jobs:
+            pending.append(pool.apply_async(_prefetch_call, (job,)))
+            if len(pending) > prefetch:
+                yield _prefetch_result(pending.popleft())
+        while pending:
+            yield _prefetch_result(pending.popleft())
+        # The workers exit normally, running their finalizers (e.g. flushing
+        # the counts of the caches)
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def configure_cpu_threads(intra_op_threads=None, inter_op_threads=None):
+    # The inter-op pool can only be sized before it is first used, so call
+    # this before loading the model
+    if inter_op_threads:
+        torch.set_num_interop_threads(inter_op_threads)
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+
+
+def shard_ranges(n, num_shards):
+    # Contiguous [start, end) ranges splitting n items into num_shards shards,
+    # whose sizes differ by one at most
+    return [(n * k // num_shards, n * (k + 1) // num_shards) for k in range(num_shards)]
+
+
+def shard_cpu_cores(num_shards):
+    # Splits the cores this process may run on into num_shards disjoint sets,
+    # or spreads the shards over the cores if there are more shards
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(multiprocessing.cpu_count()))
+    if num_shards >= len(cores):
+        return [[cores[k % len(cores)]] for k in range(num_shards)]
+    return [cores[start:end] for start, end in shard_ranges(len(cores), num_shards)]
+
+
+def pin_cpu_cores(cores):
+    # Keeps this process on cores, with one intra-op thread per core
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    configure_cpu_threads(len(cores), 1)
+
+
+def prepare_cpu_model(net, channels_last=True):
+    # Inference only copy of the backbone on the CPU. channels_last lets the
+    # mkldnn convolutions skip the layout conversion of every layer.
+    net = net.cpu().eval()
+    for p in net.parameters():
+        p.requires_grad_(False)
+    if channels_last:
+        net = net.to(memory_format=torch.channels_last)
+    return net
+
+
+def quantize_backbone(net, calibration_images, backend='x86'):
+    # Static post-training int8 quantization (FX graph mode): observers are
+    # inserted in the graph, calibrated on a few images, and the
+    # convolutions are converted to int8 kernels. The result runs on CPU.
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    torch.backends.quantized.engine = backend
+    net = copy.deepcopy(net).cpu().eval()
+    prepared = prepare_fx(net, get_default_qconfig_mapping(backend), example_inputs=(calibration_images[0],))
+    with torch.no_grad():
+        for I in calibration_images:
+            prepared(I)
+    return convert_fx(prepared)
+
+
+def quantize_rmac_head(head):
+    # Dynamic int8 quantization of the PCA: int8 weights, activations
+    # quantized on the fly. The result runs on CPU.
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(head).cpu(), {nn.Linear}, dtype=torch.qint8)
+
+
+class RMACDescriptor(nn.Module):
+    def __init__(self, backbone, head):
+        # Backbone and R-MAC head in a single module: images and their rois
+        # in, one descriptor per image out
+        super(RMACDescriptor, self).__init__()
+        self.backbone = backbone
+        self.head = head
+
+    def forward(self, images, rois):
+        return self.head(self.backbone(images), rois)
+
+
+def export_descriptor_model(net, head, example_image, path):
+    # Saves the backbone (traced, it is a plain conv net so the trace holds
+    # for any input size) and the R-MAC head (scripted, its shapes depend on
+    # the rois) as one file that loads without the model source. The weights
+    # are kept out of the TorchScript archive, which only stores the code,
+    # and saved beside it so that load_descriptor_model can memory-map them.
+    net = copy.deepcopy(net).cpu().eval()
+    with torch.no_grad():
+        backbone = torch.jit.trace(net, example_image)
+    model = torch.jit.script(RMACDescriptor(backbone, copy.deepcopy(head).cpu().eval()))
+    state_dict = collections.OrderedDict((k, v.detach().clone()) for k, v in model.state_dict().items())
+    for name in state_dict:
+        _set_script_tensor(model, name, torch.empty(0))
+    code = io.BytesIO()
+    torch.jit.save(model, code)
+    torch.save({'code': code.getvalue(), 'state_dict': state_dict}, path)
+
+
+def load_descriptor_model(path, device='cpu', mmap=True):
+    # Inverse of export_descriptor_model. With mmap the weights are mapped
+    # from the file instead of read, so the model loads in a few ms and the
+    # pages are shared by all the processes using it on the CPU.
+    archive = torch.load(path, map_location='cpu', mmap=mmap, weights_only=True)
+    model = torch.jit.load(io.BytesIO(archive['code']), map_location='cpu')
+    for name, value in archive['state_dict'].items():
+        _set_script_tensor(model, name, value)
+    return model.to(device).eval()
+
+
+def _set_script_tensor(module, name, value):
+    path = name.split('.')
+    for attr in path[:-1]:
+        module = getattr(module, attr)
+    setattr(module, path[-1], value)
+
+
 class L2Normalization(Module):
     def __init__(self):
         """
@@ -88,14 +1166,9 @@ class L2Normalization(Module):
         self.eps = 1e-8
         
     def forward(self, x):
-        if x.is_cuda:
-            caped_eps = Variable(torch.Tensor([self.eps])).cuda(torch.cuda.device_of(x).idx)
-        else:
-            caped_eps = Variable(torch.Tensor([self.eps]))
-        x = torch.div(x.transpose(0,1),x.max(1)[0]).transpose(0,1) # max_normed
-        norm = torch.norm(x,2,1) + caped_eps.expand(x.size()[0])
-        y = torch.div(x.transpose(0,1),norm).transpose(0,1)
-        return y
+        x = x / x.max(1, keepdim=True)[0]  # max_normed
+        norm = torch.norm(x, 2, 1, keepdim=True) + self.eps
+        return x / norm
 
 
 class Shift(nn.Module):
@@ -103,13 +1176,63 @@ class Shift(nn.Module):
         super(Shift, self).__init__()
         #self.bias = nn.Parameter(torch.ones(dim))
         self.bias = nn.Parameter(torch.Tensor(dim))
-        self.bias.data.uniform_(-0.006, -0.03)
+        self.bias.data.uniform_(-0.03, -0.006)
     def forward(self, input):
         output = torch.add(input, self.bias)
         
         return output
 
 
+class RMACHead(nn.Module):
+    def __init__(self, pca_shift, pca_fc, spatial_scale=0.03125):
+        # R-MAC module on top of the res5c feature map. The PCA shift is
+        # folded into the bias of the PCA: W (x + s) + b = W x + (W s + b)
+        super(RMACHead, self).__init__()
+        self.r_mac_pool = RoIPool(1, 1, spatial_scale)
+        self.l2norm = L2Normalization()
+        weight = pca_fc.weight.data
+        self.pca_fc = nn.Linear(weight.size(1), weight.size(0), bias=True)
+        self.pca_fc.weight.data = weight.clone()
+        self.pca_fc.bias.data = (weight.double().mv(pca_shift.bias.data.double()) + pca_fc.bias.data.double()).float()
+
+    def forward(self, features, rois):
+        # features is the feature map of a batch of images, and the first
+        # column of rois the image of each region. Returns one descriptor per
+        # image: (#batch, #channel)
+        g = self.r_mac_pool(features, rois)
+        g = g.view(g.size(0), g.size(1))  # (#batch * # regions, #channel)
+        return self.aggregate(g, rois[:, 0].long(), features.size(0))
+
+    def aggregate(self, g, batch_inds, batch_size):
+        # type: (Tensor, Tensor, int) -> Tensor
+        # Descriptors of the images from the pooled vectors g of their
+        # regions, batch_inds being the image of each region
+        g = self.l2norm(g)
+        g = self.pca_fc(g)  # PCA
+        g = self.l2norm(g)  # normalize each region
+
+        # sum-aggregation per image
+        out = torch.zeros(batch_size, g.size(1), dtype=g.dtype, device=g.device)
+        out = out.index_add_(0, batch_inds, g)
+        # Final L2
+        return self.l2norm(out)
+
+    def forward_pooling(self, features, rois, pooling, p=3.0):
+        # Same as forward, with the regions average pooled ('spoc') or
+        # pooled with a generalized mean of exponent p ('gem') instead of max
+        # pooled. Meant for a few large regions, e.g. the whole image.
+        coords = torch.round(rois[:, 1:] * self.r_mac_pool.spatial_scale).long()
+        hstart, hend = _roi_bin_bounds(coords[:, 1], coords[:, 3], 1, features.size(2))
+        wstart, wend = _roi_bin_bounds(coords[:, 0], coords[:, 2], 1, features.size(3))
+        g = []
+        for r, i in enumerate(rois[:, 0].long().tolist()):
+            x = features[i, :, int(hstart[r, 0]):int(hend[r, 0]), int(wstart[r, 0]):int(wend[r, 0])]
+            if pooling == 'gem':
+                g.append(x.clamp(min=1e-6).pow(p).mean((1, 2)).pow(1.0 / p))
+            else:
+                g.append(x.mean((1, 2)))
+        return self.aggregate(torch.stack(g), rois[:, 0].long(), features.size(0))
+
 
 class RoIPool(nn.Module):
     def __init__(self, pooled_height, pooled_width, spatial_scale):
@@ -119,41 +1242,84 @@ class RoIPool(nn.Module):
         self.spatial_scale = float(spatial_scale)
 
     def forward(self, features, rois):
+        # All the rois of the batch are pooled at once. Every bin is a
+        # rectangle of the feature map, so its max is taken along the height
+        # first and then along the width of those row maxima.
         batch_size, num_channels, data_height, data_width = features.size()
-        num_rois = rois.size()[0]
-        
-        outputs = Variable(torch.zeros(num_rois, num_channels,
-                                       self.pooled_height,
-                                       self.pooled_width))
-        if features.is_cuda:
-            outputs = outputs.cuda(torch.cuda.device_of(features).idx)
-
-        for roi_ind, roi in enumerate(rois):
-            # batch_ind = int(roi[0].data[0])
-            batch_ind = int(roi[0].item())
-            roi_start_w, roi_start_h, roi_end_w, roi_end_h = roi_start_w, roi_start_h, roi_end_w, roi_end_h = torch.round(roi[1:]* self.spatial_scale).data.cpu().numpy().astype(int)
-            roi_width = max(roi_end_w - roi_start_w + 1, 1)
-            roi_height = max(roi_end_h - roi_start_h + 1, 1)
-            bin_size_w = float(roi_width) / float(self.pooled_width)
-            bin_size_h = float(roi_height) / float(self.pooled_height)
-
-            for ph in range(self.pooled_height):
-                hstart = int(np.floor(ph * bin_size_h))
-                hend = int(np.ceil((ph + 1) * bin_size_h))
-                hstart = min(data_height, max(0, hstart + roi_start_h))
-                hend = min(data_height, max(0, hend + roi_start_h))
-                for pw in range(self.pooled_width):
-                    wstart = int(np.floor(pw * bin_size_w))
-                    wend = int(np.ceil((pw + 1) * bin_size_w))
-                    wstart = min(data_width, max(0, wstart + roi_start_w))
-                    wend = min(data_width, max(0, wend + roi_start_w))
-
-                    is_empty = (hend <= hstart) or(wend <= wstart)
-                    if is_empty:
-                        outputs[roi_ind, :, ph, pw] = 0
-                    else:
-                        data = features[batch_ind]
-                        outputs[roi_ind, :, ph, pw] = torch.max(
-                            torch.max(data[:, hstart:hend, wstart:wend], 1, keepdim = True)[0], 2, keepdim = True)[0].view(-1)  # noqa
-
-        return outputs
+        num_rois = rois.size(0)
+
+        batch_inds = rois[:, 0].long()
+        coords = torch.round(rois[:, 1:] * self.spatial_scale).long()
+        hstart, hend = _roi_bin_bounds(coords[:, 1], coords[:, 3], self.pooled_height, data_height)
+        wstart, wend = _roi_bin_bounds(coords[:, 0], coords[:, 2], self.pooled_width, data_width)
+
+        # Grid rois share a lot of row ranges, each distinct (image, rows)
+        # pair is reduced once: (#segments, 1, #channel, width)
+        segments = torch.stack([batch_inds.unsqueeze(1).expand_as(hstart), hstart, hend], 2).view(-1, 3)
+        segments, inverse = torch.unique(segments, dim=0, return_inverse=True)
+        rows = _segment_max(features, segments[:, 0], segments[:, 1:2], segments[:, 2:3])
+        # (#rois * pooled_height, pooled_width, #channel, 1)
+        rows = rows.view(segments.size(0), num_channels, data_width, 1)
+        outputs = _segment_max(rows, inverse, wstart.repeat_interleave(self.pooled_height, 0),
+                               wend.repeat_interleave(self.pooled_height, 0))
+
+        outputs = outputs.view(num_rois, self.pooled_height, self.pooled_width, num_channels)
+        is_empty = (hend <= hstart).unsqueeze(2) | (wend <= wstart).unsqueeze(1)
+        outputs = outputs.masked_fill(is_empty.unsqueeze(3), 0)
+        return outputs.permute(0, 3, 1, 2).contiguous()
+
+
+def _roi_bin_bounds(roi_start, roi_end, pooled, size):
+    # type: (Tensor, Tensor, int, int) -> Tuple[Tensor, Tensor]
+    # Same arithmetic as the caffe RoIPooling layer: bins are computed in
+    # double precision and clipped to the feature map.
+    roi_len = torch.clamp(roi_end - roi_start + 1, min=1).double()
+    bin_size = (roi_len / float(pooled)).unsqueeze(1)
+    p = torch.arange(pooled, dtype=torch.float64, device=roi_start.device).unsqueeze(0)
+    start = torch.floor(p * bin_size).long() + roi_start.unsqueeze(1)
+    end = torch.ceil((p + 1) * bin_size).long() + roi_start.unsqueeze(1)
+    return torch.clamp(start, 0, size), torch.clamp(end, 0, size)
+
+
+def _segment_max(x, index, start, end):
+    # type: (Tensor, Tensor, Tensor, Tensor) -> Tensor
+    # out[q, p] = max(x[index[q], :, start[q, p]:end[q, p]], dim=1) for x of
+    # shape (N, A, n, M). With at most one segment per row of x they are
+    # reduced directly under a mask, otherwise through a sparse table of
+    # maxima over power-of-two windows, built once and shared by all of them.
+    # Empty segments are garbage, the caller masks them out.
+    n = x.size(2)
+    num_levels = 1
+    while 1 << num_levels <= n:
+        num_levels += 1
+    if start.numel() <= x.size(0):
+        pos = torch.arange(n, device=x.device)
+        outside = (pos < start.unsqueeze(2)) | (pos >= end.unsqueeze(2))
+        masked = x[index].unsqueeze(1).masked_fill(outside[:, :, None, :, None], float('-inf'))
+        return masked.max(3)[0]
+
+    # table[k, :, :, i] = max(x[:, :, i:i + 2**k]). Entries whose window runs
+    # past the end are left uninitialized, they are never queried.
+    if torch.is_grad_enabled() and x.requires_grad:
+        # out= is not differentiable, the levels are stacked instead (those
+        # entries are then copies of the previous level)
+        levels = [x]
+        for level in range(1, num_levels):
+            span = 1 << (level - 1)
+            levels.append(torch.cat([torch.max(levels[-1][:, :, :n - span], levels[-1][:, :, span:]), levels[-1][:, :, n - span:]], 2))
+        table = torch.stack(levels)
+    else:
+        table = torch.empty([num_levels] + list(x.size()), dtype=x.dtype, device=x.device)
+        table[0] = x
+        for level in range(1, num_levels):
+            span = 1 << (level - 1)
+            torch.max(table[level - 1, :, :, :n - span], table[level - 1, :, :, span:], out=table[level, :, :, :n - span])
+
+    # [start, end) is covered by the two windows of length 2**k starting at
+    # start and end - 2**k
+    length = torch.clamp(end - start, min=1)
+    k = (length.unsqueeze(2) >= 2 ** torch.arange(1, num_levels, device=x.device)).sum(2)
+    first = torch.clamp(start, 0, n - 1)
+    last = torch.clamp(first + length - 2 ** k, 0, n - 1)
+    index = index.unsqueeze(1)
+    return torch.max(table[k, index, :, first], table[k, index, :, last])
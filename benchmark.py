@@ -0,0 +1,371 @@
+import torch
+import torch.nn as nn
+
+from Common import L2Normalization
+from Common import RMACHead
+from Common import RoIPool
+from Common import Shift
+from Common import _rmac_region_coordinates
+from Common import build_ivf_index
+from Common import build_pq_index
+from Common import get_rmac_regions_for_network
+from Common import search
+from Common import top_k
+from test_python3_pytorch import average_query_expansion
+from test_python3_pytorch import database_dbe
+
+import sys
+import numpy as np
+import argparse
+import json
+import multiprocessing
+import platform
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+# Micro-benchmarks of the hot paths of the extraction and the search. They
+# need no dataset nor weights: the feature maps and the descriptors are random
+# and the PCA of the R-MAC head has random weights, at the sizes of the real
+# ones (2048-d, res5c maps of images resized to S).
+
+
+def random_descriptors(n, dim=2048, seed=0):
+    # L2 normalized descriptors, generated in blocks to bound the memory of
+    # the random floats
+    x = np.empty((n, dim), dtype=np.float32)
+    rng = np.random.RandomState(seed)
+    for start in range(0, n, 65536):
+        block = rng.standard_normal((min(65536, n - start), dim)).astype(np.float32)
+        x[start:start + len(block)] = block / np.sqrt((block * block).sum(axis=1))[:, None]
+    return x
+
+
+def random_rmac_head(dim=2048, seed=0):
+    torch.manual_seed(seed)
+    pca_shift = Shift(dim)
+    pca_shift.bias.data = torch.randn(dim) * 0.01
+    pca_fc = nn.Linear(dim, dim, bias=True)
+    return RMACHead(pca_shift, pca_fc).eval()
+
+
+def random_feature_map(S, batch_size=1, dim=2048, seed=0):
+    # res5c map of batch_size images of S x 3S/4, and their R-MAC regions
+    H, W = int(round(S * 0.75)), S
+    torch.manual_seed(seed)
+    features = torch.relu(torch.randn(batch_size, dim, int(np.ceil(H / 32.0)), int(np.ceil(W / 32.0))))
+    return features, [(H, W)] * batch_size
+
+
+def legacy_roipool(features, rois, pooled_height, pooled_width, spatial_scale):
+    # The original RoIPool, one region and one bin at a time, that the
+    # vectorized one must match
+    num_channels, data_height, data_width = features.size()[1:]
+    outputs = torch.zeros(rois.size(0), num_channels, pooled_height, pooled_width, dtype=features.dtype)
+    for roi_ind, roi in enumerate(rois):
+        batch_ind = int(roi[0].item())
+        roi_start_w, roi_start_h, roi_end_w, roi_end_h = torch.round(roi[1:] * spatial_scale).cpu().numpy().astype(int)
+        roi_width = max(roi_end_w - roi_start_w + 1, 1)
+        roi_height = max(roi_end_h - roi_start_h + 1, 1)
+        bin_size_w = float(roi_width) / float(pooled_width)
+        bin_size_h = float(roi_height) / float(pooled_height)
+
+        for ph in range(pooled_height):
+            hstart = int(np.floor(ph * bin_size_h))
+            hend = int(np.ceil((ph + 1) * bin_size_h))
+            hstart = min(data_height, max(0, hstart + roi_start_h))
+            hend = min(data_height, max(0, hend + roi_start_h))
+            for pw in range(pooled_width):
+                wstart = int(np.floor(pw * bin_size_w))
+                wend = int(np.ceil((pw + 1) * bin_size_w))
+                wstart = min(data_width, max(0, wstart + roi_start_w))
+                wend = min(data_width, max(0, wend + roi_start_w))
+                if hend > hstart and wend > wstart:
+                    data = features[batch_ind]
+                    outputs[roi_ind, :, ph, pw] = torch.max(
+                        torch.max(data[:, hstart:hend, wstart:wend], 1, keepdim=True)[0], 2, keepdim=True)[0].view(-1)
+    return outputs
+
+
+def check_roipool(args, num_cases=20, seed=0):
+    # Names of the seeded cases where RoIPool differs from legacy_roipool:
+    # the R-MAC grids of --batch_size images, and random regions (some of
+    # them past the borders or empty) pooled into random bins, with and
+    # without autograd
+    rng = np.random.RandomState(seed)
+    torch.manual_seed(seed)
+    features, shapes = random_feature_map(args.S, args.batch_size, dim=64, seed=seed)
+    cases = [('grid', features, torch.from_numpy(get_rmac_regions_for_network(shapes, args.L)), 1, 1, 0.03125)]
+    for k in range(num_cases):
+        batch_size, height, width = rng.randint(1, 4), rng.randint(1, 20), rng.randint(1, 20)
+        features = torch.randn(batch_size, 16, height, width)
+        num_rois = rng.randint(1, 40)
+        corners = rng.randint(-64, 32 * max(height, width) + 64, size=(num_rois, 2, 2))
+        rois = np.hstack((rng.randint(0, batch_size, size=(num_rois, 1)), corners.min(axis=1), corners.max(axis=1)))
+        cases.append(('random{0}'.format(k), features, torch.from_numpy(rois.astype(np.float32)), rng.randint(1, 8), rng.randint(1, 8), 0.03125))
+    mismatches = []
+    for name, features, rois, pooled_height, pooled_width, spatial_scale in cases:
+        expected = legacy_roipool(features, rois, pooled_height, pooled_width, spatial_scale)
+        pool = RoIPool(pooled_height, pooled_width, spatial_scale)
+        with torch.no_grad():
+            pooled = pool(features, rois)
+        if not torch.equal(pooled, expected) or not torch.equal(pool(features.requires_grad_(), rois).detach(), expected):
+            mismatches.append(name)
+    return mismatches
+
+
+def get_benchmarks(args):
+    # {name: setup}, setup() builds the inputs and returns (run, items), run()
+    # being the timed call and items the number of images, regions, queries
+    # or database vectors it processes
+    benchmarks = {}
+
+    def region_coordinates():
+        # Without the cache of the grids
+        shapes = [(600 + k, 800) for k in range(64)]
+
+        def run():
+            for H, W in shapes:
+                _rmac_region_coordinates.__wrapped__(H, W, args.L)
+        return run, len(shapes)
+    benchmarks['region_coordinates'] = region_coordinates
+
+    def regions_for_network():
+        shapes = [(int(round(args.S * 0.75)), args.S)] * 8
+        return (lambda: get_rmac_regions_for_network(shapes, args.L)), len(shapes)
+    benchmarks['regions_for_network'] = regions_for_network
+
+    def roipool(batch_size):
+        def setup():
+            features, shapes = random_feature_map(args.S, batch_size)
+            rois = torch.from_numpy(get_rmac_regions_for_network(shapes, args.L))
+            pool = RoIPool(1, 1, 0.03125)
+            return (lambda: pool(features, rois)), batch_size
+        return setup
+    benchmarks['roipool'] = roipool(1)
+    benchmarks['roipool_batch{0}'.format(args.batch_size)] = roipool(args.batch_size)
+
+    def rmac_head():
+        features, shapes = random_feature_map(args.S)
+        rois = torch.from_numpy(get_rmac_regions_for_network(shapes, args.L))
+        head = random_rmac_head()
+        return (lambda: head(features, rois)), 1
+    benchmarks['rmac_head'] = rmac_head
+
+    def l2norm():
+        x = torch.randn(args.regions, 2048)
+        normalize = L2Normalization()
+        return (lambda: normalize(x)), args.regions
+    benchmarks['l2norm'] = l2norm
+
+    def similarity(n):
+        def setup():
+            queries, dataset = random_descriptors(args.queries, seed=1), random_descriptors(n)
+            return (lambda: queries.dot(dataset.T)), args.queries
+        return setup
+
+    def argsort(n):
+        def setup():
+            sim = random_descriptors(args.queries, seed=1).dot(random_descriptors(n).T)
+            return (lambda: np.argsort(sim, axis=1)[:, ::-1]), args.queries
+        return setup
+
+    def topk(n):
+        def setup():
+            sim = random_descriptors(args.queries, seed=1).dot(random_descriptors(n).T)
+            return (lambda: top_k(sim, args.topk)), args.queries
+        return setup
+
+    def sharded_search(n, num_threads):
+        def setup():
+            queries, dataset = random_descriptors(args.queries, seed=1), random_descriptors(n)
+            return (lambda: search(queries, dataset, args.topk, num_threads=num_threads)), args.queries
+        return setup
+
+    def ivf(n):
+        def setup():
+            queries, dataset = random_descriptors(args.queries, seed=1), random_descriptors(n)
+            temp_dir = tempfile.mkdtemp()
+            index = build_ivf_index(os.path.join(temp_dir, 'ivf.rdesc'), dataset, min(args.ivf, n), iterations=3)
+            # The memory map outlives the files
+            shutil.rmtree(temp_dir)
+            return (lambda: index.search(queries, args.topk, args.nprobe)), args.queries
+        return setup
+
+    def pq(n):
+        def setup():
+            queries, dataset = random_descriptors(args.queries, seed=1), random_descriptors(n)
+            temp_dir = tempfile.mkdtemp()
+            index = build_pq_index(os.path.join(temp_dir, 'pq.rdesc'), dataset, args.pq, iterations=3, sample_size=16384)
+            shutil.rmtree(temp_dir)
+            return (lambda: index.search(queries, args.topk, args.rerank)), args.queries
+        return setup
+
+    def aqe(n):
+        def setup():
+            queries, dataset = random_descriptors(args.queries, seed=1), random_descriptors(n)
+            sim = queries.dot(dataset.T)
+            return (lambda: average_query_expansion(queries, dataset, sim, args.aqe)), args.queries
+        return setup
+
+    def dbe(n):
+        def setup():
+            dataset = random_descriptors(n)
+            return (lambda: database_dbe(dataset, args.dbe)), n
+        return setup
+
+    for n in args.db_sizes:
+        benchmarks['similarity_{0}'.format(n)] = similarity(n)
+        benchmarks['argsort_{0}'.format(n)] = argsort(n)
+        benchmarks['topk_{0}'.format(n)] = topk(n)
+        benchmarks['search_{0}'.format(n)] = sharded_search(n, 1)
+        if args.search_threads > 1:
+            benchmarks['search_threads{0}_{1}'.format(args.search_threads, n)] = sharded_search(n, args.search_threads)
+        benchmarks['ivf{0}_nprobe{1}_{2}'.format(args.ivf, args.nprobe, n)] = ivf(n)
+        benchmarks['pq{0}_rerank{1}_{2}'.format(args.pq, args.rerank, n)] = pq(n)
+        benchmarks['aqe_{0}'.format(n)] = aqe(n)
+    for n in args.dbe_sizes:
+        benchmarks['dbe_{0}'.format(n)] = dbe(n)
+    return benchmarks
+
+
+def current_rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def run_benchmark(setup, min_time, min_repeats, queue):
+    # Runs in its own process, so that the peak memory is that of the
+    # benchmark: the peak RSS above the RSS before its setup
+    start_rss = current_rss()
+    try:
+        with torch.no_grad():
+            run, items = setup()
+            # Warm up
+            run()
+            times = []
+            while len(times) < min_repeats or sum(times) < min_time:
+                start = time.perf_counter()
+                run()
+                times.append(time.perf_counter() - start)
+    except Exception as e:
+        queue.put({'error': repr(e)})
+        raise
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    queue.put({'ops_per_s': len(times) / sum(times),
+               'items_per_s': items * len(times) / sum(times),
+               'median_s': float(np.median(times)),
+               'repeats': len(times),
+               'peak_mb': max(peak_rss - start_rss, 0) / 2.0**20})
+
+
+def compare(results, baseline, tolerance, selected):
+    # Names of the benchmarks more than tolerance slower than the baseline,
+    # and of the benchmarks of the baseline that failed or no longer exist.
+    # selected(name) tells the benchmarks left out on purpose (--only).
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        ratio = result['ops_per_s'] / baseline['results'][name]['ops_per_s']
+        result['vs_baseline'] = ratio
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+    missing = sorted(name for name in baseline['results'] if name not in results and selected(name))
+    return regressions, missing
+
+
+def parse_sizes(spec):
+    return [int(float(n)) for n in spec.split(',') if n]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the R-MAC extraction and search on synthetic data')
+    parser.add_argument('--S', type=int, default=800, help='Size of the synthetic images, whose feature maps are pooled')
+    parser.add_argument('--L', type=int, default=2, help='Number of levels of the R-MAC regions')
+    parser.add_argument('--batch_size', type=int, default=8, help='Number of images of the batched RoIPool benchmark')
+    parser.add_argument('--regions', type=int, default=1024, help='Number of vectors normalized by the L2 benchmark')
+    parser.add_argument('--queries', type=int, default=55, help='Number of queries of the search benchmarks')
+    parser.add_argument('--db_sizes', type=parse_sizes, default=[5000, 100000], help='Comma separated database sizes of the search benchmarks (e.g. 5000,100000,1000000)')
+    parser.add_argument('--dbe_sizes', type=parse_sizes, default=[5000], help='Comma separated database sizes of the database side expansion, which is quadratic')
+    parser.add_argument('--topk', type=int, default=100, help='Number of neighbors of the top-k benchmarks')
+    parser.add_argument('--ivf', type=int, default=256, help='Number of lists of the inverted file index benchmarks')
+    parser.add_argument('--nprobe', type=int, default=16, help='Number of lists searched by the inverted file index benchmarks')
+    parser.add_argument('--pq', type=int, default=64, help='Bytes per code of the product quantization benchmarks')
+    parser.add_argument('--rerank', type=int, default=1000, help='Number of candidates re-ranked by the product quantization benchmarks')
+    parser.add_argument('--aqe', type=int, default=1, help='Average query expansion with k neighbors')
+    parser.add_argument('--dbe', type=int, default=20, help='Database expansion with k neighbors')
+    parser.add_argument('--threads', type=int, required=False, help='Number of intra-op threads')
+    parser.add_argument('--search_threads', type=int, default=1, help='Also benchmark the search over this many database shards in parallel, which share the intra-op threads')
+    parser.add_argument('--min_time', type=float, default=1.0, help='Minimum time spent running each benchmark, in seconds')
+    parser.add_argument('--min_repeats', type=int, default=3, help='Minimum number of timed runs of each benchmark')
+    parser.add_argument('--only', type=str, required=False, help='Only run the benchmarks whose name contains one of these comma separated strings')
+    parser.add_argument('--output', type=str, required=False, help='Save the results to this JSON file')
+    parser.add_argument('--baseline', type=str, required=False, help='Compare against the results saved in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Flag the benchmarks whose ops/s dropped by more than this fraction of the baseline')
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    def selected(name):
+        return not args.only or any(s in name for s in args.only.split(','))
+
+    benchmarks = dict((name, setup) for name, setup in get_benchmarks(args).items() if selected(name))
+
+    # Each benchmark is forked from this process before any torch operation
+    # has started the thread pools
+    context = multiprocessing.get_context('fork')
+    results = {}
+    print ("{0:<24} {1:>12} {2:>14} {3:>12} {4:>10}".format('benchmark', 'ops/s', 'items/s', 'median ms', 'peak MB'))
+    for name, setup in benchmarks.items():
+        queue = context.Queue()
+        p = context.Process(target=run_benchmark, args=(setup, args.min_time, args.min_repeats, queue))
+        p.start()
+        p.join()
+        # A benchmark killed by the OOM killer sends nothing
+        result = queue.get() if not queue.empty() else {'error': 'exit code {0}'.format(p.exitcode)}
+        if 'error' in result:
+            print ("{0:<24} failed: {1}".format(name, result['error']))
+            continue
+        results[name] = result
+        print ("{0:<24} {1:>12.2f} {2:>14.1f} {3:>12.3f} {4:>10.1f}".format(
+            name, result['ops_per_s'], result['items_per_s'], 1000 * result['median_s'], result['peak_mb']))
+
+    # Outside of the benchmarks, once they are all forked
+    roipool_mismatches = []
+    if selected('roipool'):
+        roipool_mismatches = check_roipool(args)
+        print (20 * "-")
+        print ("RoIPool against the per-region loop: {0}".format(
+            'mismatch in ' + ', '.join(roipool_mismatches) if roipool_mismatches else 'OK'))
+
+    regressions, missing = [], []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions, missing = compare(results, baseline, args.tolerance, selected)
+        print (20 * "-")
+        for name in sorted(results):
+            if 'vs_baseline' in results[name]:
+                print ("{0:<24} {1:>7.2f}x{2}".format(name, results[name]['vs_baseline'], '  REGRESSION' if name in regressions else ''))
+        for name in missing:
+            print ("{0:<24} {1:>8}  FAILED OR MISSING".format(name, '-'))
+
+    if args.output:
+        config = dict((k, v) for k, v in vars(args).items() if k not in ('output', 'baseline', 'only'))
+        with open(args.output, 'w') as f:
+            json.dump({'config': config,
+                       'machine': {'python': platform.python_version(), 'torch': torch.__version__, 'numpy': np.__version__,
+                                   'processor': platform.processor(), 'threads': torch.get_num_threads()},
+                       'results': results}, f, indent=2)
+        print ("Saved the results to {0}".format(args.output))
+    if regressions:
+        print ("{0} regression(s) above {1:.0f}%: {2}".format(len(regressions), 100 * args.tolerance, ', '.join(regressions)))
+    if missing:
+        print ("{0} benchmark(s) of the baseline failed or are missing: {1}".format(len(missing), ', '.join(missing)))
+    if roipool_mismatches:
+        print ("RoIPool differs from the per-region loop in {0} case(s)".format(len(roipool_mismatches)))
+    if regressions or missing or roipool_mismatches:
+        sys.exit(1)
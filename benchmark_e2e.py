@@ -0,0 +1,414 @@
+import torch
+import torch.nn as nn
+
+from Common import ArrayCache
+from Common import build_ivf_index
+from Common import build_pq_index
+from Common import quantize_backbone
+from Common import quantize_rmac_head
+from Common import recall_at_k
+from Common import search
+from benchmark import random_rmac_head
+from test_python3_pytorch import Dataset
+from test_python3_pytorch import ImageHelper
+from test_python3_pytorch import average_query_expansion
+from test_python3_pytorch import database_dbe
+from test_python3_pytorch import extract_features
+from test_python3_pytorch_no_cuda import compute_features_sharded
+
+import sys
+import numpy as np
+import argparse
+import contextlib
+import copy
+import cv2
+import functools
+import json
+import os
+import resource
+import shutil
+import threading
+import time
+
+# End-to-end benchmark of extract_features -> DBE -> AQE -> scoring on a
+# synthetic corpus laid out as Oxford / Paris, with a small random-weight
+# ResNet. Every optimized path is checked against the reference one (no
+# batching, no workers, no cache, float) so that speedups do not change the
+# results unnoticed, and the approximate indexes by their recall of the
+# exact nearest neighbors.
+
+# compute_ap of Oxford / Paris, used unless --eval_binary is given
+COMPUTE_AP = '''import sys
+prefix, rnk = sys.argv[1], sys.argv[2]
+read = lambda suffix: set(l.strip() for l in open(prefix + suffix) if l.strip())
+pos = read('_good.txt') | read('_ok.txt')
+junk = read('_junk.txt')
+old_recall, old_precision, ap, intersect, j = 0.0, 1.0, 0.0, 0, 0
+for r in [l.strip() for l in open(rnk) if l.strip()]:
+    if r in junk:
+        continue
+    if r in pos:
+        intersect += 1
+    recall, precision = intersect / float(len(pos)), intersect / (j + 1.0)
+    ap += (recall - old_recall) * ((old_precision + precision) / 2.0)
+    old_recall, old_precision = recall, precision
+    j += 1
+print(ap)
+'''
+
+
+class Bottleneck(nn.Module):
+    def __init__(self, in_channels, channels, stride):
+        super(Bottleneck, self).__init__()
+        self.conv1 = nn.Conv2d(in_channels, channels, 1, bias=False)
+        self.bn1 = nn.BatchNorm2d(channels)
+        self.conv2 = nn.Conv2d(channels, channels, 3, stride=stride, padding=1, bias=False)
+        self.bn2 = nn.BatchNorm2d(channels)
+        self.conv3 = nn.Conv2d(channels, 4 * channels, 1, bias=False)
+        self.bn3 = nn.BatchNorm2d(4 * channels)
+        self.relu = nn.ReLU()
+        self.downsample = nn.Sequential(nn.Conv2d(in_channels, 4 * channels, 1, stride=stride, bias=False),
+                                        nn.BatchNorm2d(4 * channels))
+
+    def forward(self, x):
+        out = self.relu(self.bn1(self.conv1(x)))
+        out = self.relu(self.bn2(self.conv2(out)))
+        out = self.bn3(self.conv3(out))
+        return self.relu(out + self.downsample(x))
+
+
+class SmallResNet(nn.Module):
+    def __init__(self, width=16):
+        # ResNet with one bottleneck per stage, whose last stage has the
+        # stride (32) and the 2048 channels of res5c
+        super(SmallResNet, self).__init__()
+        self.stem = nn.Sequential(nn.Conv2d(3, width, 7, stride=2, padding=3, bias=False), nn.BatchNorm2d(width),
+                                  nn.ReLU(), nn.MaxPool2d(3, stride=2, padding=1))
+        self.layer1 = Bottleneck(width, width, 1)
+        self.layer2 = Bottleneck(4 * width, 2 * width, 2)
+        self.layer3 = Bottleneck(8 * width, 4 * width, 2)
+        self.layer4 = Bottleneck(16 * width, 512, 2)
+
+    def forward(self, x):
+        return self.layer4(self.layer3(self.layer2(self.layer1(self.stem(x)))))
+
+
+def random_network(width=16, seed=0):
+    torch.manual_seed(seed)
+    net = SmallResNet(width)
+    # Random running statistics, so that the batch norms are not identities
+    for m in net.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.running_mean.uniform_(-0.1, 0.1)
+            m.running_var.uniform_(0.5, 1.5)
+    return net.eval()
+
+
+def make_corpus(path, num_landmarks, images_per_landmark, seed=0):
+    # Oxford / Paris layout: jpg/ holds the images, lab/ the query files. The
+    # images of a landmark are crops of the same random texture at a few
+    # sizes, with noise. The first image of each landmark is its query, the
+    # others are good, and those of the next landmark are junk.
+    rng = np.random.RandomState(seed)
+    shapes = [(768, 1024), (1024, 768), (683, 1024), (800, 800)]
+    for d in ('jpg', 'lab'):
+        if not os.path.exists(os.path.join(path, d)):
+            os.makedirs(os.path.join(path, d))
+    names = []
+    for l in range(num_landmarks):
+        texture = cv2.resize(rng.randint(0, 256, (24, 24, 3)).astype(np.uint8), (1400, 1400), interpolation=cv2.INTER_CUBIC)
+        names.append([])
+        for k in range(images_per_landmark):
+            H, W = shapes[rng.randint(len(shapes))]
+            y, x = rng.randint(0, 1400 - H + 1), rng.randint(0, 1400 - W + 1)
+            im = texture[y:y + H, x:x + W].astype(np.float32) + rng.normal(0, 12, (H, W, 3))
+            name = 'landmark{0:03d}_{1:06d}'.format(l, k)
+            cv2.imwrite(os.path.join(path, 'jpg', name + '.jpg'), np.clip(im, 0, 255).astype(np.uint8))
+            names[-1].append((name, H, W))
+    for l in range(num_landmarks):
+        q_name, H, W = names[l][0]
+        query = 'landmark{0:03d}_1'.format(l)
+        with open(os.path.join(path, 'lab', query + '_query.txt'), 'w') as f:
+            f.write("oxc1_{0} {1:.1f} {2:.1f} {3:.1f} {4:.1f}\n".format(q_name, W * 0.1, H * 0.1, W * 0.9, H * 0.9))
+        for suffix, images in (('good', names[l][1:]), ('ok', []), ('junk', names[(l + 1) % num_landmarks][:1])):
+            with open(os.path.join(path, 'lab', "{0}_{1}.txt".format(query, suffix)), 'w') as f:
+                f.write(''.join(name + '\n' for name, _, _ in images))
+
+
+class PeakRSS:
+    def __init__(self, interval=0.005):
+        # Peak resident memory of the process during a with block, sampled in
+        # a thread
+        self.interval = interval
+
+    def _rss(self):
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self._rss())
+
+    def __enter__(self):
+        self.peak = self._rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._rss())
+        return False
+
+
+def load_random_model(S, L, means, width, device):
+    # (image helper, network) of the workers of the processes path, the same
+    # random ones as those of the other paths
+    image_helper = ImageHelper(S, L, means, load_head=False)
+    image_helper.rmac_head = random_rmac_head()
+    image_helper.device = device
+    return image_helper, random_network(width).to(device)
+
+
+def run_stage(stats, name, items, func):
+    # func(), recording its time, throughput and peak memory in stats
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+    stats[name] = {'seconds': elapsed, 'items_per_s': items / elapsed, 'peak_rss_mb': rss.peak / 2.0**20}
+    return result
+
+
+def extract_sharded(dataset, queries, run_args):
+    # Database features of the processes path, extracted by
+    # compute_features_sharded in run_args.processes processes. It only
+    # shards the database, the queries are those of the reference.
+    fnames = [dataset.get_filename(i) for i in range(dataset.N_images)]
+    load = functools.partial(load_random_model, L=run_args.L, means=run_args.means, width=run_args.width, device=run_args.device)
+    features = compute_features_sharded(fnames, run_args.S, os.path.join(run_args.temp_dir, 'dataset.npy'), run_args, load)
+    # L2 normalized again, as by load_multiscale_features
+    return queries, features / np.sqrt((features * features).sum(axis=1))[:, None]
+
+
+def run_pipeline(dataset, image_helper, net, args, extract=None, **options):
+    # Extraction with the options of a path, or by extract(run_args), then
+    # DBE, AQE and scoring. Returns the stats of each stage, the
+    # descriptors, the final similarities and the mAP.
+    run_args = argparse.Namespace(**dict(vars(args), **options))
+    if os.path.exists(run_args.temp_dir):
+        shutil.rmtree(run_args.temp_dir)
+    os.makedirs(run_args.temp_dir)
+    # extract_sharded only extracts the database
+    extracted = dataset.N_queries + dataset.N_images if extract is None else dataset.N_images
+    if extract is None:
+        extract = lambda run_args: extract_features(dataset, image_helper, net, run_args)
+    stats = {}
+    with torch.no_grad():
+        features_queries, features_dataset = run_stage(stats, 'extract', extracted,
+                                                       lambda: extract(run_args))
+    expanded = features_dataset
+    if args.dbe > 0:
+        expanded = run_stage(stats, 'dbe', dataset.N_images, lambda: database_dbe(features_dataset, args.dbe))
+
+    def search():
+        sim = features_queries.dot(expanded.T)
+        if args.aqe > 0:
+            _, sim = average_query_expansion(features_queries, expanded, sim, args.aqe)
+        return sim
+    sim = run_stage(stats, 'search', dataset.N_queries, search)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        map_ = run_stage(stats, 'score', dataset.N_queries, lambda: dataset.score(sim, run_args.temp_dir, args.eval_binary))
+    return {'stats': stats, 'queries': features_queries, 'dataset': features_dataset, 'sim': sim, 'map': map_}
+
+
+def same_rankings(reference_sim, sim, topk, atol):
+    # Fraction of queries ranked the same in their top k. A ranking is the
+    # same if the image at each position has the reference similarity of the
+    # reference image at that position, so that ties may be swapped.
+    topk = min(topk, reference_sim.shape[1])
+    same = 0
+    for q in range(len(reference_sim)):
+        ref_rank = np.argsort(-reference_sim[q], kind='stable')[:topk]
+        run_rank = np.argsort(-sim[q], kind='stable')[:topk]
+        same += np.all(np.abs(reference_sim[q, ref_rank] - reference_sim[q, run_rank]) <= atol)
+    return same / float(len(reference_sim))
+
+
+def compare_runs(reference, run, topk, atol):
+    # Largest descriptor difference, cosine to the reference descriptors, and
+    # fraction of queries ranked the same in their top k, by the search of
+    # the descriptors and at the end (after DBE and AQE)
+    descriptors = np.vstack((reference['queries'], reference['dataset']))
+    other = np.vstack((run['queries'], run['dataset']))
+    cosine = (descriptors * other).sum(axis=1)
+    return {'max_abs_diff': float(np.abs(descriptors - other).max()),
+            'min_cosine': float(cosine.min()),
+            'mean_cosine': float(cosine.mean()),
+            'same_search': same_rankings(reference['queries'].dot(reference['dataset'].T), run['queries'].dot(run['dataset'].T), topk, atol),
+            'same_ranking': same_rankings(reference['sim'], run['sim'], topk, atol),
+            'map_diff': float(run['map'] - reference['map'])}
+
+
+def check_indexes(reference, args):
+    # recall@k of the IVF and PQ indexes of the reference descriptors
+    # against the exact search, and the throughput of their searches
+    queries, database = reference['queries'], reference['dataset']
+    k = min(args.ann_k, len(database))
+    exact = search(queries, database, k)[1]
+    index_dir = os.path.join(args.temp_dir, 'indexes')
+    if os.path.exists(index_dir):
+        shutil.rmtree(index_dir)
+    os.makedirs(index_dir)
+    indexes = []
+    if args.ivf > 0:
+        ivf = build_ivf_index(os.path.join(index_dir, 'ivf.rdesc'), database, min(args.ivf, len(database)))
+        indexes.append(('ivf', lambda: ivf.search(queries, k, args.nprobe)[1]))
+    if args.pq > 0:
+        pq = build_pq_index(os.path.join(index_dir, 'pq.rdesc'), database, args.pq, args.opq)
+        indexes.append(('pq', lambda: pq.search(queries, k, args.rerank)[1]))
+    checks = {}
+    for name, index_search in indexes:
+        stats = {}
+        idx = run_stage(stats, 'search', len(queries), index_search)
+        recall = recall_at_k(idx, exact)
+        checks[name] = {'stats': stats, 'recall': recall, 'ok': bool(recall >= args.min_recall)}
+    return checks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='End-to-end throughput of the extraction and search on a synthetic corpus')
+    parser.add_argument('--temp_dir', type=str, required=True, help='Directory of the synthetic corpus, features and scores')
+    parser.add_argument('--landmarks', type=int, default=20, help='Number of landmarks, each with a query')
+    parser.add_argument('--images_per_landmark', type=int, default=10, help='Number of database images of each landmark')
+    parser.add_argument('--S', type=int, default=512, help='Resize larger side of image to S pixels')
+    parser.add_argument('--L', type=int, default=2, help='Use L spatial levels')
+    parser.add_argument('--width', type=int, default=16, help='Width of the first stage of the random ResNet')
+    parser.add_argument('--batch_size', type=int, default=8, help='Batch size of the batched paths')
+    parser.add_argument('--workers', type=int, default=2, help='Number of loading processes of the workers path')
+    parser.add_argument('--processes', type=int, default=2, help='Number of extraction processes of the processes path (0: skip it)')
+    parser.add_argument('--quantize', type=int, default=8, help='Number of calibration images of the int8 path (0: skip it)')
+    parser.add_argument('--aqe', type=int, default=1, help='Average query expansion with k neighbors')
+    parser.add_argument('--dbe', type=int, default=5, help='Database expansion with k neighbors')
+    parser.add_argument('--eval_binary', type=str, required=False, help='compute_ap binary (default: a python version of it)')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='Device of the network')
+    parser.add_argument('--topk', type=int, default=100, help='Number of ranked images compared against the reference')
+    parser.add_argument('--atol', type=float, default=1e-5, help='Largest descriptor and similarity difference of the exact paths')
+    parser.add_argument('--min_cosine', type=float, default=0.99, help='Smallest cosine to the reference descriptors of the int8 path')
+    parser.add_argument('--ivf', type=int, default=8, help='Number of lists of the IVF index checked (0: skip it)')
+    parser.add_argument('--nprobe', type=int, default=4, help='Number of lists searched in the IVF index')
+    parser.add_argument('--pq', type=int, default=64, help='Bytes per code of the PQ index checked (0: skip it)')
+    parser.add_argument('--opq', type=int, default=2, help='Iterations of OPQ of the PQ index')
+    parser.add_argument('--rerank', type=int, default=50, help='Number of PQ candidates re-ranked with the float descriptors')
+    parser.add_argument('--ann_k', type=int, default=10, help='Number of nearest neighbors whose recall is checked')
+    parser.add_argument('--min_recall', type=float, default=0.9, help='Smallest recall@ann_k of the indexes')
+    parser.add_argument('--output', type=str, required=False, help='Save the stats and the checks to this JSON file')
+    args = parser.parse_args()
+
+    corpus = os.path.join(args.temp_dir, 'corpus')
+    if not os.path.exists(corpus):
+        print ("Generating {0} images in {1}".format(args.landmarks * args.images_per_landmark, corpus))
+        make_corpus(corpus, args.landmarks, args.images_per_landmark)
+    if args.eval_binary is None:
+        with open(os.path.join(args.temp_dir, 'compute_ap.py'), 'w') as f:
+            f.write(COMPUTE_AP)
+        args.eval_binary = "{0} {1}".format(sys.executable, os.path.join(args.temp_dir, 'compute_ap.py'))
+    args.means = np.array([103.93900299,  116.77899933,  123.68000031], dtype=np.float32)[None, :, None, None]
+    args.dataset_name = 'Synthetic'
+    args.multires = False
+    args.batch_pad = 0
+    args.prefetch = 16
+    args.chunk_size = 0
+    # Extraction options of the processes path
+    args.cpu_inference = False
+    args.warmup = 0
+
+    dataset = Dataset(corpus, args.eval_binary)
+    net = random_network(args.width).to(args.device)
+    image_helper = ImageHelper(args.S, args.L, args.means, load_head=False)
+    image_helper.rmac_head = random_rmac_head()
+    image_helper.device = args.device
+
+    # name: (image helper, network, options, check). The exact paths must
+    # give the reference descriptors and final ranking. The descriptors of
+    # the processes path are computed by other code (no_cuda, one image at a
+    # time), whose rounding differs. Near ties of the DBE neighbors can
+    # amplify it, so its ranking is compared before DBE and AQE. The int8
+    # path is only checked by the cosine to the reference descriptors.
+    paths = [('reference', image_helper, net, dict(batch_size=1, workers=0), 'exact'),
+             ('batched', image_helper, net, dict(batch_size=args.batch_size, workers=0), 'exact'),
+             ('workers', image_helper, net, dict(batch_size=args.batch_size, workers=args.workers), 'exact')]
+    cached_helper = copy.copy(image_helper)
+    cached_helper.image_cache = ArrayCache(os.path.join(args.temp_dir, 'image_cache'), np.uint8)
+    paths.append(('image_cache', cached_helper, net, dict(batch_size=args.batch_size, workers=0), 'exact'))
+    if args.processes > 0:
+        paths.append(('processes', image_helper, net, dict(processes=args.processes), 'search'))
+    if args.quantize > 0:
+        int8_helper = copy.copy(image_helper)
+        int8_helper.device = 'cpu'
+        int8_helper.rmac_head = quantize_rmac_head(image_helper.rmac_head)
+        calibration = [torch.from_numpy(image_helper.prepare_image_and_grid_regions_for_network(dataset.get_filename(i))[0])
+                       for i in range(min(args.quantize, dataset.N_images))]
+        int8_net = quantize_backbone(net, calibration)
+        paths.append(('int8', int8_helper, int8_net, dict(batch_size=1, workers=0), 'cosine'))
+
+    results = {}
+    reference = None
+    failed = []
+    for name, helper, model, options, kind in paths:
+        if name == 'image_cache':
+            # Fill the cache first, only the run from the cache is timed
+            run_pipeline(dataset, helper, model, args, temp_dir=os.path.join(args.temp_dir, name), **options)
+        extract = None
+        if name == 'processes':
+            extract = functools.partial(extract_sharded, dataset, reference['queries'])
+        run = run_pipeline(dataset, helper, model, args, extract=extract, temp_dir=os.path.join(args.temp_dir, name), **options)
+        results[name] = {'stats': run['stats'], 'map': run['map']}
+        if reference is None:
+            reference = run
+        else:
+            check = compare_runs(reference, run, args.topk, args.atol)
+            if kind == 'exact':
+                check['ok'] = bool(check['max_abs_diff'] <= args.atol and check['same_ranking'] == 1.0)
+            elif kind == 'search':
+                check['ok'] = bool(check['max_abs_diff'] <= args.atol and check['same_search'] == 1.0)
+            else:
+                check['ok'] = bool(check['min_cosine'] >= args.min_cosine)
+            results[name]['check'] = check
+            if not check['ok']:
+                failed.append(name)
+
+    index_checks = check_indexes(reference, args)
+    low_recall = [name for name, check in index_checks.items() if not check['ok']]
+
+    print ("{0:<12} {1:>14} {2:>14} {3:>15} {4:>15} {5:>12} {6:>8}".format('path', 'extract img/s', 'dbe vectors/s', 'search queries/s', 'score queries/s', 'peak RSS MB', 'mAP'))
+    for name, result in results.items():
+        stats = result['stats']
+        print ("{0:<12} {1:>14.2f} {2:>14.1f} {3:>15.1f} {4:>15.1f} {5:>12.1f} {6:>8.2f}".format(
+            name, stats['extract']['items_per_s'], stats['dbe']['items_per_s'] if 'dbe' in stats else 0,
+            stats['search']['items_per_s'], stats['score']['items_per_s'],
+            max(s['peak_rss_mb'] for s in stats.values()), 100 * result['map']))
+    print (20 * "-")
+    for name, result in results.items():
+        if 'check' in result:
+            check = result['check']
+            print ("{0:<12} max diff {1:.2e}, min cosine {2:.6f}, same top-{3} search {4:.1f}%, ranking {5:.1f}%, mAP {6:+.2f}: {7}".format(
+                name, check['max_abs_diff'], check['min_cosine'], args.topk, 100 * check['same_search'], 100 * check['same_ranking'],
+                100 * check['map_diff'], 'OK' if check['ok'] else 'MISMATCH'))
+    for name, check in index_checks.items():
+        print ("{0:<12} {1:.1f} queries/s, recall@{2} {3:.4f}: {4}".format(
+            name, check['stats']['search']['items_per_s'], args.ann_k, check['recall'], 'OK' if check['ok'] else 'LOW RECALL'))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': dict((k, v) for k, v in vars(args).items() if k != 'means'), 'results': results, 'indexes': index_checks}, f, indent=2)
+        print ("Saved the results to {0}".format(args.output))
+    if failed:
+        print ("Paths that changed the results: {0}".format(', '.join(failed)))
+    if low_recall:
+        print ("Indexes below a recall@{0} of {1}: {2}".format(args.ann_k, args.min_recall, ', '.join(low_recall)))
+    if failed or low_recall:
+        sys.exit(1)
@@ -6,6 +6,10 @@ from torch.autograd import Variable
 from Common import L2Normalization
 from Common import Shift
 from Common import RoIPool
+from Common import get_rmac_region_coordinates
+from Common import metrics
+from Common import load_multiscale_features
+from Common import search
 
 import imp
 import sys
@@ -21,6 +25,7 @@ import pdb
 import re
 import time
 
+# Queries searched, named and written at a time
 NUM_CONSTANT = 500
 
 class ImageHelper:
@@ -66,32 +71,37 @@ class ImageHelper:
         rois = Variable(torch.FloatTensor(R))
         # feature map
         # h = torch.nn.DataParallel(net(Variable(torch.from_numpy(I).cuda())))
-        h = net(Variable(torch.from_numpy(I).cuda()))
-        h = h.cpu().data
+        with metrics.stage('forward'):
+            h = net(Variable(torch.from_numpy(I).cuda()))
+            h = h.cpu().data
 
         # R-MAC module
-        g = self.r_mac_pool(h, rois)
-        g = g.squeeze(2).squeeze(2)  # (#batch * # regions, #channel)
-        g = self.l2norm(g)
-        g = self.pca_shift(g)
-        g = self.pca_fc(g)  # PCA
-        g = self.l2norm(g)  # normalize each region
-
-        # sum-aggregation
-        g = torch.sum(g, dim=0, keepdim=True)
-        # Final L2
-        g = self.l2norm(g)
+        with metrics.stage('roipool'):
+            g = self.r_mac_pool(h, rois)
+        with metrics.stage('pca'):
+            g = g.squeeze(2).squeeze(2)  # (#batch * # regions, #channel)
+            g = self.l2norm(g)
+            g = self.pca_shift(g)
+            g = self.pca_fc(g)  # PCA
+            g = self.l2norm(g)  # normalize each region
+
+            # sum-aggregation
+            g = torch.sum(g, dim=0, keepdim=True)
+            # Final L2
+            g = self.l2norm(g)
 
         return g
 
     def load_and_prepare_image(self, fname, roi=None):
         # Read image, get aspect ratio, and resize such as the largest side equals S
         print(fname)
-        im = cv2.imread(fname)
+        with metrics.stage('decode'):
+            im = cv2.imread(fname)
         im_size_hw = np.array(im.shape[0:2])
         ratio = float(self.S)/np.max(im_size_hw)
         new_size = tuple(np.round(im_size_hw * ratio).astype(np.int32))
-        im_resized = cv2.resize(im, (new_size[1], new_size[0]))
+        with metrics.stage('resize'):
+            im_resized = cv2.resize(im, (new_size[1], new_size[0]))
         # If there is a roi, adapt the roi to the new size and crop. Do not rescale
         # the image once again
         if roi is not None:
@@ -121,57 +131,7 @@ class ImageHelper:
         return R
 
     def get_rmac_region_coordinates(self, H, W, L):
-        # Almost verbatim from Tolias et al Matlab implementation.
-        # Could be heavily pythonized, but really not worth it...
-        # Desired overlap of neighboring regions
-        ovr = 0.4
-        # Possible regions for the long dimension
-        steps = np.array((2, 3, 4, 5, 6, 7), dtype=np.float32)
-        w = np.minimum(H, W)
-
-        b = (np.maximum(H, W) - w) / (steps - 1)
-        # steps(idx) regions for long dimension. The +1 comes from Matlab
-        # 1-indexing...
-        idx = np.argmin(np.abs(((w**2 - w * b) / w**2) - ovr)) + 1
-
-        # Region overplus per dimension
-        Wd = 0
-        Hd = 0
-        if H < W:
-            Wd = idx
-        elif H > W:
-            Hd = idx
-
-        regions_xywh = []
-        for l in range(1, L+1):
-            wl = np.floor(2 * w / (l + 1))
-            wl2 = np.floor(wl / 2 - 1)
-            # Center coordinates
-            if l + Wd - 1 > 0:
-                b = (W - wl) / (l + Wd - 1)
-            else:
-                b = 0
-            cenW = np.floor(wl2 + b * np.arange(l - 1 + Wd + 1)) - wl2
-            # Center coordinates
-            if l + Hd - 1 > 0:
-                b = (H - wl) / (l + Hd - 1)
-            else:
-                b = 0
-            cenH = np.floor(wl2 + b * np.arange(l - 1 + Hd + 1)) - wl2
-
-            for i_ in cenH:
-                for j_ in cenW:
-                    regions_xywh.append([j_, i_, wl, wl])
-
-        # Round the regions. Careful with the borders!
-        for i in range(len(regions_xywh)):
-            for j in range(4):
-                regions_xywh[i][j] = int(round(regions_xywh[i][j]))
-            if regions_xywh[i][0] + regions_xywh[i][2] > W:
-                regions_xywh[i][0] -= ((regions_xywh[i][0] + regions_xywh[i][2]) - W)
-            if regions_xywh[i][1] + regions_xywh[i][3] > H:
-                regions_xywh[i][1] -= ((regions_xywh[i][1] + regions_xywh[i][3]) - H)
-        return np.array(regions_xywh).astype(np.float32)
+        return get_rmac_region_coordinates(H, W, L)
 
 
 class Dataset:
@@ -197,20 +157,16 @@ class Dataset:
         self.N_images = len(self.index_imagenames)
         self.N_queries = len(self.query_imagenames)
 
-    def score(self, sim, part, temp_dir):
+    def score(self, idx, part, temp_dir):
+        # Names of the queries of block part and of their ranked images, from
+        # the indices of their nearest neighbors
         if not os.path.exists(temp_dir):
             os.makedirs(temp_dir)
 
-        idx = np.argsort(sim, axis=1)[:, ::-1]
-        idx = idx[:, :150]
-
         rnk_100 = np.array(self.index_imagenames)[idx]
         # rnk_100 = rnk[:, :100]
 
-        if (part+1)*NUM_CONSTANT > len(self.q_names):
-            query_name = self.q_names[part*NUM_CONSTANT:]
-        else:
-            query_name = self.q_names[part*NUM_CONSTANT:(part+1)*NUM_CONSTANT]
+        query_name = self.q_names[part*NUM_CONSTANT:(part+1)*NUM_CONSTANT]
 
         return query_name, rnk_100.tolist()
 
@@ -234,11 +190,11 @@ def extract_features(dataset, image_helper, net, args):
             features_queries = np.zeros((N_queries, dim_features), dtype=np.float32)
             for i in tqdm(range(N_queries), file=sys.stdout, leave=False, dynamic_ncols=True):
                 # Load image, process image, get image regions, feed into the network, get descriptor, and store
-                I, R = image_helper.prepare_image_and_grid_regions_for_network(dataset.get_query_filename(i), roi=None)
-                features_queries[i] = image_helper.get_rmac_features(I, R, net).detach().numpy()
+                with metrics.stage('extract_query'):
+                    I, R = image_helper.prepare_image_and_grid_regions_for_network(dataset.get_query_filename(i), roi=None)
+                    features_queries[i] = image_helper.get_rmac_features(I, R, net).detach().numpy()
             np.save(out_queries_fname, features_queries)
-    features_queries = np.dstack([np.load("{0}/{1}_S{2}_L{3}_queries.npy".format(args.temp_dir, args.dataset_name, S, args.L)) for S in Ss]).sum(axis=2)
-    features_queries /= np.sqrt((features_queries * features_queries).sum(axis=1))[:, None]
+    features_queries = load_multiscale_features(["{0}/{1}_S{2}_L{3}_queries.npy".format(args.temp_dir, args.dataset_name, S, args.L) for S in Ss])
 
     # Second part, dataset
     for S in Ss:
@@ -251,40 +207,27 @@ def extract_features(dataset, image_helper, net, args):
             features_dataset = np.zeros((N_dataset, dim_features), dtype=np.float32)
             for i in tqdm(range(N_dataset), file=sys.stdout, leave=False, dynamic_ncols=True):
                 # Load image, process image, get image regions, feed into the network, get descriptor, and store
-                I, R = image_helper.prepare_image_and_grid_regions_for_network(dataset.get_filename(i), roi=None)
-                features_dataset[i] = image_helper.get_rmac_features(I, R, net).detach().numpy()
+                with metrics.stage('extract_image'):
+                    I, R = image_helper.prepare_image_and_grid_regions_for_network(dataset.get_filename(i), roi=None)
+                    features_dataset[i] = image_helper.get_rmac_features(I, R, net).detach().numpy()
             np.save(out_dataset_fname, features_dataset)
-    features_dataset = np.dstack([np.load("{0}/{1}_S{2}_L{3}_dataset.npy".format(args.temp_dir, args.dataset_name, S, args.L)) for S in Ss]).sum(axis=2)
-    features_dataset /= np.sqrt((features_dataset * features_dataset).sum(axis=1))[:, None]
+    features_dataset = load_multiscale_features(["{0}/{1}_S{2}_L{3}_dataset.npy".format(args.temp_dir, args.dataset_name, S, args.L) for S in Ss])
     # Restore the original scale
     image_helper.S = args.S
     return features_queries, features_dataset
 
 
-def database_dbe(features_dataset, dbe):
+def database_dbe(features_dataset, dbe, memory_budget=2**30, num_threads=1):
     # Extend the database features
-    # With larger datasets this has to be done in a batched way.
-    # and using smarter ways than sorting to take the top k results.
-    # For 5k images, not really a problem to do it by brute force
-    nd = features_dataset.shape[0] // NUM_CONSTANT + 1
-    feature_new_list = []
-
-    for k in tqdm(range(nd), file=sys.stdout, leave=False, dynamic_ncols=True):
-        if (k + 1) * NUM_CONSTANT > features_dataset.shape[0]:
-            feature = features_dataset[k * NUM_CONSTANT:, :]
-        else:
-            feature = features_dataset[k * NUM_CONSTANT:(k + 1) * NUM_CONSTANT]
-
-        X = feature.dot(features_dataset.T)
-        idx = np.argsort(X, axis=1)[:, ::-1]
-        idx = idx[:, 0:50]
+    # The neighbors are searched by tiles of the similarity matrix of at most
+    # memory_budget bytes, over num_threads shards of the database
+    with metrics.stage('dbe_search'):
+        _, idx = search(features_dataset, features_dataset, dbe + 1, memory_budget, num_threads)
+    with metrics.stage('dbe_average'):
         weights = np.hstack(([1], (dbe - np.arange(0, dbe)) / float(dbe)))
         weights_sum = weights.sum()
-        feature_new = np.vstack(
-            [np.dot(weights, features_dataset[idx[i, :dbe + 1], :]) / weights_sum for i in range(len(feature))])
-        feature_new_list.append(feature_new)
-
-    return np.vstack(feature_new_list)
+        return np.vstack(
+            [np.dot(weights, features_dataset[idx[i, :dbe + 1], :]) / weights_sum for i in range(len(features_dataset))])
 
 
 
@@ -302,11 +245,17 @@ if __name__ == '__main__':
     parser.add_argument('--multires', dest='multires', action='store_true', help='Enable multiresolution features')
     # parser.add_argument('--aqe', type=int, required=False, help='Average query expansion with k neighbors')
     parser.add_argument('--dbe', type=int, required=False, help='Database expansion with k neighbors')
+    parser.add_argument('--search_memory', type=float, default=1, help='Memory in GB of the tiles of similarities of the nearest neighbor searches')
+    parser.add_argument('--search_threads', type=int, default=1, help='Search the database in this many shards in parallel, each thread with its share of the intra-op threads')
+    parser.add_argument('--metrics', type=str, required=False, help='Time each stage of the extraction and search, and save the counts, times and latency histograms to this file at the end')
+    parser.add_argument('--metrics_format', type=str, default='json', choices=['json', 'prometheus'], help='Format of the --metrics file')
     parser.set_defaults(multires=False)
     args = parser.parse_args()
 
     if not os.path.exists(args.temp_dir):
         os.makedirs(args.temp_dir)
+    if args.metrics:
+        metrics.enable()
 
     # Load and reshape the means to subtract to the inputs
     args.means = np.array([103.93900299,  116.77899933,  123.68000031], dtype=np.float32)[None, :, None, None]
@@ -334,40 +283,47 @@ if __name__ == '__main__':
     if args.dbe is not None and args.dbe > 0:
         output_database_dbe = "{0}/{1}_S{2}_L{3}_dataset_dbe.npy".format(args.temp_dir, args.dataset_name, args.S, args.L)
         if not os.path.exists(output_database_dbe):
-            features_dataset = database_dbe(features_dataset, args.dbe)
+            features_dataset = database_dbe(features_dataset, args.dbe, int(args.search_memory * 2**30), args.search_threads)
             np.save(output_database_dbe, features_dataset)
         else:
             features_dataset = np.load(output_database_dbe)
 
     # Compute similarity
     aqe_list = [1, 2, 5]
+    memory_budget = int(args.search_memory * 2**30)
 
-    num = features_queries.shape[0]//NUM_CONSTANT + 1
+    # NUM_CONSTANT queries at a time, so that the names and rows of the CSV
+    # files are those of a block. Each search goes by tiles of the
+    # similarity matrix of at most --search_memory.
+    num = (features_queries.shape[0] + NUM_CONSTANT - 1) // NUM_CONSTANT
     for index in tqdm(range(num), file=sys.stdout, leave=False, dynamic_ncols=True):
-        if (index+1)*NUM_CONSTANT > features_queries.shape[0]:
-            features_query = features_queries[index*NUM_CONSTANT:, :]
-        else:
-            features_query = features_queries[index*NUM_CONSTANT:(index+1)*NUM_CONSTANT]
-        sim = features_query.dot(features_dataset.T)
-
-        # Average query expansion?
-        idx = np.argsort(sim, axis=1)[:, ::-1]
+        features_query = features_queries[index*NUM_CONSTANT:(index+1)*NUM_CONSTANT]
+        with metrics.stage('search'):
+            _, idx = search(features_query, features_dataset, max(aqe_list) + 7, memory_budget, args.search_threads)
         for aqe in aqe_list:
             print('aqe = ', aqe)
+            # Average query expansion
             # Sort the results to get the nearest neighbors, compute average
             # representations, and query again.
             # No need to L2-normalize as we are on the query side, so it doesn't
             # affect the ranking
-            # idx = np.argsort(sim, axis=1)[:, ::-1]
-            features_query = np.vstack([np.vstack((features_query[i], features_dataset[idx[i, 7:aqe+7]])).mean(axis=0) for i in range(len(features_query))])
-            sim = features_query.dot(features_dataset.T)
+            with metrics.stage('aqe_average'):
+                features_query = np.vstack([np.vstack((features_query[i], features_dataset[idx[i, 7:aqe+7]])).mean(axis=0) for i in range(len(features_query))])
+            with metrics.stage('search'):
+                _, rnk_idx = search(features_query, features_dataset, 150, memory_budget, args.search_threads)
 
             # Score
-            query_name, rnk_100 = dataset.score(sim, index, args.temp_dir)
+            with metrics.stage('score'):
+                query_name, rnk_100 = dataset.score(rnk_idx, index, args.temp_dir)
 
             csv_file = "{0}/submit_QE{1}.csv".format(args.temp_dir, aqe)
-            with open(csv_file, 'a') as fw:
-                for id, images in zip(query_name, rnk_100):
-                    img_names = [img.split('.')[0] for img in images]
-                    line = id + ',' + ' '.join(img_names) + '\n'
-                    fw.write(line)
+            with metrics.stage('write_csv'):
+                with open(csv_file, 'a') as fw:
+                    for id, images in zip(query_name, rnk_100):
+                        img_names = [img.split('.')[0] for img in images]
+                        line = id + ',' + ' '.join(img_names) + '\n'
+                        fw.write(line)
+
+    if args.metrics:
+        metrics.dump(args.metrics, args.metrics_format)
+        print ("Saved the metrics to {0}".format(args.metrics))
@@ -1,11 +1,31 @@
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.autograd import Variable
 
-from Common import L2Normalization
 from Common import Shift
-from Common import RoIPool
+from Common import RMACHead
+from Common import export_descriptor_model
+from Common import load_descriptor_model
+from Common import get_rmac_region_coordinates
+from Common import get_rmac_regions_for_network
+from Common import prefetch_map
+from Common import imread_reduced
+from Common import ArrayCache
+from Common import compute_in_chunks
+from Common import load_multiscale_features
+from Common import save_descriptors
+from Common import DescriptorStore
+from Common import file_hash
+from Common import save_array
+from Common import quantize_backbone
+from Common import quantize_rmac_head
+from Common import metrics
+from Common import top_k
+from Common import search
+from Common import build_pq_index
+from Common import load_pq_index
+from Common import is_current_store
+from Common import recall_at_k
 
 import imp
 import sys
@@ -17,156 +37,189 @@ import os
 from collections import OrderedDict
 import subprocess
 import pdb
+import re
+import copy
+import io
+import time
 
 class ImageHelper:
-    def __init__(self, S, L, means):
+    def __init__(self, S, L, means, load_head=True):
         self.S = S
         self.L = L
         self.means = means
-        self.l2norm = L2Normalization()
-        # RoI max pooling
-        self.r_mac_pool = RoIPool(1, 1, 0.03125)
-
+        self.device = 'cuda'
+        # Decode JPEGs at a reduced size when it is still larger than S
+        self.fast_decode = False
+        # Optional ArrayCaches of the resized images and of the float16
+        # res5c feature maps
+        self.image_cache = None
+        self.feature_cache = None
+        # Hash of the backbone whose maps are in the feature cache
+        self.backbone_hash = None
+        # Without the head, the networks given to get_rmac_features are
+        # exported descriptor models that include it
+        self.rmac_head = None
+        if not load_head:
+            return
         self.pca_shift = Shift(2048)
         self.pca_shift.bias.data = torch.Tensor(np.load('centered2.npy'))
         self.pca_fc = nn.Linear(2048, 2048, bias=True)
         # Load the PCA weights learned with off-the-shelf Resnet101
         self.pca_fc.weight.data = torch.Tensor(np.load('weights/pca_weight.npy'))
         self.pca_fc.bias.data = torch.Tensor(np.load('weights/pca_bias.npy'))
+        self.rmac_head = RMACHead(self.pca_shift, self.pca_fc)
 
     def prepare_image_and_grid_regions_for_network(self, fname, roi=None):
         # Extract image, resize at desired size, and extract roi region if
         # available. Then compute the rmac grid in the net format: ID X Y W H
         I, im_resized = self.load_and_prepare_image(fname, roi)
-        if self.L == 0:
-            # Encode query in mac format instead of rmac, so only one region
-            # Regions are in ID X Y W H format
-            R = np.zeros((1, 5), dtype=np.float32)
-            R[0, 3] = im_resized.shape[1] - 1
-            R[0, 4] = im_resized.shape[0] - 1
-        else:
-            # Get the region coordinates and feed them to the network.
-            all_regions = []
-            all_regions.append(self.get_rmac_region_coordinates(im_resized.shape[0], im_resized.shape[1], self.L))
-            R = self.pack_regions_for_network(all_regions)
+        # With L == 0 the query is encoded in mac format instead of rmac, so
+        # only one region
+        R = get_rmac_regions_for_network([im_resized.shape[:2]], self.L)
         return I, R
 
+    def prepare_multiscale_images_and_grid_regions_for_network(self, fname, roi, Ss):
+        # Same as prepare_image_and_grid_regions_for_network at each scale of
+        # Ss, but the image is read and decoded only once: [(I, R), ...]
+        prepared = []
+        for im_resized in self.load_resized_images(fname, roi, Ss):
+            I = im_resized.transpose(2, 0, 1) - self.means
+            prepared.append((I, get_rmac_regions_for_network([im_resized.shape[:2]], self.L)))
+        return prepared
+
     def get_rmac_features(self, I, R, net):
-        # net.blobs['data'].reshape(I.shape[0], 3, int(I.shape[2]), int(I.shape[3]))
-        # net.blobs['data'].data[:] = I
-        # net.blobs['rois'].reshape(R.shape[0], R.shape[1])
-        # net.blobs['rois'].data[:] = R.astype(np.float32)
-        # net.forward()
-
-        rois = Variable(torch.FloatTensor(R))
-        # feature map
-        # h = Variable(np.array(net.blobs['res5c'].data)
-        h = net(Variable(torch.from_numpy(I).cuda()))
-        h = h.cpu().data
-        # h =  np.squeeze(net.blobs['res5c'].data)
-
-        # R-MAC module
-        g = self.r_mac_pool(h, rois)
-        g = g.squeeze(2).squeeze(2)  # (#batch * # regions, #channel)
-        g = self.l2norm(g)
-        g = self.pca_shift(g)
-        g = self.pca_fc(g)  # PCA
-        g = self.l2norm(g)  # normalize each region
-
-        # sum-aggregation
-        g = torch.sum(g, dim=0, keepdim=True)
-        # Final L2
-        g = self.l2norm(g)
-
-        return g
+        return self.get_rmac_features_batch(I, R, net)
+
+    def get_rmac_features_batch(self, I, R, net):
+        # I is a batch of images of the same size, and the first column of R
+        # the image of each region. The R-MAC head runs on the device of the
+        # network, only the descriptors come back: (#batch, #channel)
+        I = torch.from_numpy(I).to(self.device)
+        if self.rmac_head is None:
+            with metrics.stage('forward'):
+                return net(I, torch.from_numpy(R).to(self.device)).cpu()
+        with metrics.stage('forward'):
+            h = net(I)
+        rois = torch.from_numpy(R).to(h.device)
+        with metrics.stage('rmac_head'):
+            g = self.rmac_head.to(h.device)(h, rois)
+            return g.cpu()
+
+    def get_heads_features_batch(self, I, shapes, net, heads, cached_maps=None):
+        # Descriptors of each head (see parse_heads) for a batch of images of
+        # the same size, from a single forward pass. shapes are the sizes of
+        # the images before padding: [(#batch, #channel), ...]
+        I = torch.from_numpy(I).to(self.device)
+        if self.rmac_head is None:
+            # Exported models include their R-MAC head, called on the output
+            # of their backbone once per head
+            with metrics.stage('forward'):
+                h = net.backbone(I)
+            with metrics.stage('rmac_head'):
+                return [net.head(h, torch.from_numpy(get_rmac_regions_for_network(shapes, L)).to(self.device)).cpu() for _, _, L in heads]
+        with metrics.stage('forward'):
+            h = net(I)
+        if cached_maps is not None:
+            # Feature maps are stored in the feature cache under the
+            # (key, image shape) of cached_maps. The descriptors are computed
+            # from the float16 maps, the same as when they are pooled again
+            # from the cache.
+            h = h.half()
+            with metrics.stage('feature_cache_put'):
+                maps = h.cpu().numpy()
+                for j, (key, shape) in enumerate(cached_maps):
+                    self.feature_cache.put(key, maps[j], list(shape))
+            h = h.float()
+        return self.pool_heads(h, shapes, heads)
+
+    def get_heads_features_from_cache(self, key, heads):
+        # Descriptors of each head pooled from a feature map of the feature
+        # cache, or None if the map is not cached: [(1, #channel), ...]
+        with metrics.stage('feature_cache_get'):
+            found = self.feature_cache.lookup(key)
+        if found is None:
+            return None
+        h, shape = found
+        h = torch.from_numpy(h.astype(np.float32)[None]).to(self.device)
+        return self.pool_heads(h, [shape], heads)
+
+    def pool_heads(self, h, shapes, heads):
+        # The heads share the normalizations and the PCA of the R-MAC head.
+        # Global pooling heads pool the L == 0 region. R-MAC is rmac_head(h,
+        # rois) in two steps, to time the RoIPool and the PCA.
+        rmac_head = self.rmac_head.to(h.device)
+        features = []
+        for _, pooling, param in heads:
+            if pooling == 'rmac':
+                rois = torch.from_numpy(get_rmac_regions_for_network(shapes, param)).to(h.device)
+                with metrics.stage('roipool'):
+                    g = rmac_head.r_mac_pool(h, rois)
+                with metrics.stage('pca'):
+                    g = rmac_head.aggregate(g.view(g.size(0), g.size(1)), rois[:, 0].long(), h.size(0))
+                    features.append(g.cpu())
+            else:
+                rois = torch.from_numpy(get_rmac_regions_for_network(shapes, 0)).to(h.device)
+                with metrics.stage(pooling + '_pooling'):
+                    features.append(rmac_head.forward_pooling(h, rois, pooling, param).cpu())
+        return features
+
+    def cache_key(self, cache, fname, S, roi, *params):
+        roi_key = None if roi is None else tuple(np.asarray(roi).tolist())
+        return cache.key(fname, S, roi_key, self.fast_decode, *params)
 
     def load_and_prepare_image(self, fname, roi=None):
-        # Read image, get aspect ratio, and resize such as the largest side equals S
-        im = cv2.imread(fname)
-        im_size_hw = np.array(im.shape[0:2])
-        ratio = float(self.S)/np.max(im_size_hw)
+        im_resized = self.load_resized_images(fname, roi, [self.S])[0]
+        # Transpose for network and subtract mean
+        I = im_resized.transpose(2, 0, 1) - self.means
+        return I, im_resized
+
+    def load_resized_images(self, fname, roi, Ss):
+        # The image resized at each scale of Ss (and cropped to roi), from
+        # the image cache when it is there. The scales missing from the cache
+        # are computed from a single decode of the image.
+        keys = [None] * len(Ss)
+        images = [None] * len(Ss)
+        if self.image_cache is not None:
+            with metrics.stage('image_cache_get'):
+                keys = [self.cache_key(self.image_cache, fname, S, roi) for S in Ss]
+                images = [self.image_cache.get(key) for key in keys]
+        missing = [k for k in range(len(Ss)) if images[k] is None]
+        if missing:
+            im, im_size_hw = self.load_image(fname, max(Ss[k] for k in missing))
+            for k in missing:
+                images[k] = self.resize_image(im, Ss[k], roi, im_size_hw)
+                if keys[k] is not None:
+                    with metrics.stage('image_cache_put'):
+                        self.image_cache.put(keys[k], images[k])
+        return images
+
+    def load_image(self, fname, S):
+        # Decoded image, possibly at a reduced size, and the size of the
+        # full resolution image
+        with metrics.stage('decode'):
+            if self.fast_decode:
+                return imread_reduced(fname, S)
+            im = cv2.imread(fname)
+            return im, im.shape[0:2]
+
+    def resize_image(self, im, S, roi=None, im_size_hw=None):
+        # Get aspect ratio of the full resolution image, and resize such as
+        # the largest side equals S. im may have been decoded at a reduced
+        # size, roi is in full resolution coordinates.
+        im_size_hw = np.array(im.shape[0:2] if im_size_hw is None else im_size_hw)
+        ratio = float(S)/np.max(im_size_hw)
         new_size = tuple(np.round(im_size_hw * ratio).astype(np.int32))
-        im_resized = cv2.resize(im, (new_size[1], new_size[0]))
+        with metrics.stage('resize'):
+            im_resized = cv2.resize(im, (new_size[1], new_size[0]))
         # If there is a roi, adapt the roi to the new size and crop. Do not rescale
         # the image once again
         if roi is not None:
             roi = np.round(roi * ratio).astype(np.int32)
             im_resized = im_resized[roi[1]:roi[3], roi[0]:roi[2], :]
-        # Transpose for network and subtract mean
-        I = im_resized.transpose(2, 0, 1) - self.means
-        return I, im_resized
-
-    def pack_regions_for_network(self, all_regions):
-        n_regs = np.sum([len(e) for e in all_regions])
-        R = np.zeros((n_regs, 5), dtype=np.float32)
-        cnt = 0
-        # There should be a check of overflow...
-        for i, r in enumerate(all_regions):
-            try:
-                R[cnt:cnt + r.shape[0], 0] = i
-                R[cnt:cnt + r.shape[0], 1:] = r
-                cnt += r.shape[0]
-            except:
-                continue
-        assert cnt == n_regs
-        R = R[:n_regs]
-        # regs where in xywh format. R is in xyxy format, where the last coordinate is included. Therefore...
-        R[:n_regs, 3] = R[:n_regs, 1] + R[:n_regs, 3] - 1
-        R[:n_regs, 4] = R[:n_regs, 2] + R[:n_regs, 4] - 1
-        return R
+        return im_resized
 
     def get_rmac_region_coordinates(self, H, W, L):
-        # Almost verbatim from Tolias et al Matlab implementation.
-        # Could be heavily pythonized, but really not worth it...
-        # Desired overlap of neighboring regions
-        ovr = 0.4
-        # Possible regions for the long dimension
-        steps = np.array((2, 3, 4, 5, 6, 7), dtype=np.float32)
-        w = np.minimum(H, W)
-
-        b = (np.maximum(H, W) - w) / (steps - 1)
-        # steps(idx) regions for long dimension. The +1 comes from Matlab
-        # 1-indexing...
-        idx = np.argmin(np.abs(((w**2 - w * b) / w**2) - ovr)) + 1
-
-        # Region overplus per dimension
-        Wd = 0
-        Hd = 0
-        if H < W:
-            Wd = idx
-        elif H > W:
-            Hd = idx
-
-        regions_xywh = []
-        for l in range(1, L+1):
-            wl = np.floor(2 * w / (l + 1))
-            wl2 = np.floor(wl / 2 - 1)
-            # Center coordinates
-            if l + Wd - 1 > 0:
-                b = (W - wl) / (l + Wd - 1)
-            else:
-                b = 0
-            cenW = np.floor(wl2 + b * np.arange(l - 1 + Wd + 1)) - wl2
-            # Center coordinates
-            if l + Hd - 1 > 0:
-                b = (H - wl) / (l + Hd - 1)
-            else:
-                b = 0
-            cenH = np.floor(wl2 + b * np.arange(l - 1 + Hd + 1)) - wl2
-
-            for i_ in cenH:
-                for j_ in cenW:
-                    regions_xywh.append([j_, i_, wl, wl])
-
-        # Round the regions. Careful with the borders!
-        for i in range(len(regions_xywh)):
-            for j in range(4):
-                regions_xywh[i][j] = int(round(regions_xywh[i][j]))
-            if regions_xywh[i][0] + regions_xywh[i][2] > W:
-                regions_xywh[i][0] -= ((regions_xywh[i][0] + regions_xywh[i][2]) - W)
-            if regions_xywh[i][1] + regions_xywh[i][3] > H:
-                regions_xywh[i][1] -= ((regions_xywh[i][1] + regions_xywh[i][3]) - H)
-        return np.array(regions_xywh).astype(np.float32)
+        return get_rmac_region_coordinates(H, W, L)
 
 
 class Dataset:
@@ -242,21 +295,26 @@ class Dataset:
     def score(self, sim, temp_dir, eval_bin):
         if not os.path.exists(temp_dir):
             os.makedirs(temp_dir)
-        idx = np.argsort(sim, axis=1)[:, ::-1]
+        # compute_ap needs the whole ranking
+        with metrics.stage('ranking'):
+            idx = top_k(sim, sim.shape[1])
         maps = [self.score_rnk_partial(i, idx[i], temp_dir, eval_bin) for i in range(len(self.q_names))]
         for i in range(len(self.q_names)):
             print ("{0}: {1:.2f}".format(self.q_names[i], 100 * maps[i]))
         print (20 * "-")
         print ("Mean: {0:.2f}".format(100 * np.mean(maps)))
+        return np.mean(maps)
 
     def score_rnk_partial(self, i, idx, temp_dir, eval_bin):
-        rnk = np.array(self.img_filenames)[idx]
-        with open("{0}/{1}.rnk".format(temp_dir, self.q_names[i]), 'w') as f:
-            f.write("\n".join(rnk)+"\n")
+        with metrics.stage('write_rnk'):
+            rnk = np.array(self.img_filenames)[idx]
+            with open("{0}/{1}.rnk".format(temp_dir, self.q_names[i]), 'w') as f:
+                f.write("\n".join(rnk)+"\n")
         cmd = "{0} {1}{2} {3}/{4}.rnk".format(eval_bin, self.lab_root, self.q_names[i], temp_dir, self.q_names[i])
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        map_ = float(p.stdout.readlines()[0])
-        p.wait()
+        with metrics.stage('compute_ap'):
+            p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            map_ = float(p.stdout.readlines()[0])
+            p.wait()
         return map_
 
     def get_filename(self, i):
@@ -269,46 +327,344 @@ class Dataset:
         return self.q_roi[self.q_names[i]]
 
 
-def extract_features(dataset, image_helper, net, args):
-    Ss = [args.S, ] if not args.multires else [args.S - 250, args.S, args.S + 250]
+def get_bucket_shape(shape, pad):
+    # Images are batched together when they have the same size, or the same
+    # size once padded to a multiple of pad
+    if pad <= 0:
+        return tuple(shape)
+    return tuple(int(np.ceil(float(s) / pad)) * pad for s in shape)
+
+
+def parse_heads(spec):
+    # Descriptors computed from the same forward pass, e.g. 'rmac2,rmac3,mac,gem3'
+    # [(name, pooling, parameter), ...], name being the one of their feature
+    # files. rmacL is R-MAC with L levels, as --L L (name LL), mac the single
+    # region of L == 0 (L0), spoc average pooling of the image and gemP
+    # generalized mean pooling with exponent P (3 by default).
+    heads = []
+    for head in spec.split(','):
+        head = head.strip()
+        if re.match(r'^rmac[0-9]+$', head):
+            heads.append(('L' + head[4:], 'rmac', int(head[4:])))
+        elif head == 'mac':
+            heads.append(('L0', 'rmac', 0))
+        elif head == 'spoc':
+            heads.append(('spoc', 'spoc', None))
+        elif re.match(r'^gem([0-9]+(\.[0-9]+)?)?$', head):
+            p = head[3:] or '3'
+            heads.append(('gem' + p, 'gem', float(p)))
+        else:
+            raise argparse.ArgumentTypeError("Unknown head {0}, expected rmacL, mac, spoc or gemP".format(head))
+    return heads
+
+
+def get_heads(args):
+    # --heads, or the R-MAC of --L
+    return getattr(args, 'heads', None) or [('L{0}'.format(args.L), 'rmac', args.L)]
+
+
+def get_scales(args):
+    return [args.S, ] if not args.multires else [args.S - 250, args.S, args.S + 250]
+
+
+def compute_features(image_helper, net, fnames, rois, args):
+    head = ('L{0}'.format(image_helper.L), 'rmac', image_helper.L)
+    return compute_multiscale_features(image_helper, net, fnames, rois, [image_helper.S], [head], args)[:, 0, 0]
+
+
+def compute_multiscale_features(image_helper, net, fnames, rois, Ss, heads, args):
+    # Features of each image at each scale of Ss for each head, decoding the
+    # image once for all the scales and running the network once for all
+    # the heads: (#images, #scales, #heads, #channel)
+    dim_features = 2048
+    features = np.zeros((len(fnames), len(Ss), len(heads), dim_features), dtype=np.float32)
+    buckets = {}
+
+    # With a feature cache, the scales whose feature maps are cached are only
+    # pooled, the others go through the network and their maps are cached
+    todo = [list(range(len(Ss))) for _ in fnames]
+    map_keys = None
+    if image_helper.feature_cache is not None:
+        # The maps of another backbone are not those of this one
+        map_keys = [[image_helper.cache_key(image_helper.feature_cache, fname, S, roi, image_helper.backbone_hash) for S in Ss]
+                    for fname, roi in zip(fnames, rois)]
+        for i in tqdm(range(len(fnames)), file=sys.stdout, leave=False, dynamic_ncols=True):
+            todo[i] = []
+            for k in range(len(Ss)):
+                g = image_helper.get_heads_features_from_cache(map_keys[i][k], heads)
+                if g is None:
+                    todo[i].append(k)
+                else:
+                    features[i, k] = np.vstack([g_.detach().numpy() for g_ in g])
+    images = [i for i in range(len(fnames)) if todo[i]]
+    if images and net is None:
+        raise RuntimeError("The feature maps of {0} images are not cached, they must be extracted with the network first".format(len(images)))
+
+    def flush(key):
+        # Zero-pad in the mean subtracted space. Regions only cover the
+        # original image, padding only leaks in through the receptive field
+        # of the border activations.
+        batch = buckets.pop(key)
+        I = np.zeros((len(batch), 3) + key, dtype=np.float32)
+        for j, (i, k, I_) in enumerate(batch):
+            I[j, :, :I_.shape[2], :I_.shape[3]] = I_[0]
+        shapes = [I_.shape[2:] for _, _, I_ in batch]
+        cached_maps = None
+        if map_keys is not None:
+            cached_maps = [(map_keys[i][k], shape) for (i, k, _), shape in zip(batch, shapes)]
+        g = image_helper.get_heads_features_batch(I, shapes, net, heads, cached_maps)
+        for h, g_ in enumerate(g):
+            features[[i for i, _, _ in batch], [k for _, k, _ in batch], h] = g_.detach().numpy()
+
+    # Load image, process image and get image regions in the workers, feed
+    # into the network, get descriptor, and store
+    prepared = prefetch_map(image_helper.prepare_multiscale_images_and_grid_regions_for_network,
+                            [(fnames[i], rois[i], [Ss[k] for k in todo[i]]) for i in images],
+                            num_workers=args.workers, prefetch=args.prefetch)
+    for i, scales in zip(images, tqdm(prepared, total=len(images), file=sys.stdout, leave=False, dynamic_ncols=True)):
+        for k, (I, _) in zip(todo[i], scales):
+            # Without batching every image is its own bucket
+            key = get_bucket_shape(I.shape[2:], args.batch_pad)
+            buckets.setdefault(key, []).append((i, k, I))
+            if len(buckets[key]) >= args.batch_size:
+                flush(key)
+            elif sum(len(b) for b in buckets.values()) > 4 * args.batch_size:
+                # Too many partial buckets waiting, run the fullest one
+                flush(max(buckets, key=lambda k: len(buckets[k])))
+    for key in list(buckets):
+        flush(key)
+    return features
+
+
+def get_features_fname(args, S, part, name=None):
+    # Cached features of one scale and one head (by default the R-MAC of
+    # --L), part is 'queries' or 'dataset'
+    tag = getattr(args, 'features_tag', '')
+    name = name or 'L{0}'.format(args.L)
+    return "{0}/{1}_S{2}_{3}{4}_{5}.npy".format(args.temp_dir, args.dataset_name, S, name, tag, part)
+
+
+def extract_scales(image_helper, net, fnames, rois, Ss, heads, part, args):
+    # Extracts the features of the scales of Ss and the heads that are not
+    # cached yet, in a single pass over the images. With several of them
+    # the chunks hold them all, and are split into the per-scale and
+    # per-head files as they are merged.
+    missing = [(S, head) for S in Ss for head in heads if not os.path.exists(get_features_fname(args, S, part, head[0]))]
+    if not missing:
+        return
+    Ss = [S for S in Ss if S in [S_ for S_, _ in missing]]
+    heads = [head for head in heads if head in [head_ for _, head_ in missing]]
+    if len(Ss) == 1 and len(heads) == 1:
+        compute_in_chunks(lambda start, end: compute_multiscale_features(image_helper, net, fnames[start:end], rois[start:end], Ss, heads, args)[:, 0, 0],
+                          len(fnames), get_features_fname(args, Ss[0], part, heads[0][0]), args.chunk_size)
+        return
+    out_fname = get_features_fname(args, '-'.join(str(S) for S in Ss), part, '-'.join(head[0] for head in heads))
+    split = dict((get_features_fname(args, S, part, head[0]), (k, h)) for k, S in enumerate(Ss) for h, head in enumerate(heads) if (S, head) in missing)
+    compute_in_chunks(lambda start, end: compute_multiscale_features(image_helper, net, fnames[start:end], rois[start:end], Ss, heads, args),
+                      len(fnames), out_fname, args.chunk_size, split)
+
+
+def get_store_fname(args, part, name=None):
+    # Descriptor store of the multiresolution features of a head
+    Ss = '-'.join(str(S) for S in get_scales(args))
+    return get_features_fname(args, Ss, part, name)[:-len('.npy')] + '.rdesc'
+
+
+def save_features(args, part, name, ids):
+    # Sums the scales of a head into its descriptor store, whose rows are
+    # the images ids. An existing store must be that of the same images and
+    # of the same model, as the features of the scales it was summed from.
+    fname = get_store_fname(args, part, name)
+    if os.path.exists(fname):
+        store = DescriptorStore(fname)
+        if store.ids != list(ids):
+            raise RuntimeError("{0} holds the features of other images, remove the features of {1} from {2}".format(
+                fname, args.dataset_name, args.temp_dir))
+        if store.header.get('model_hash') != getattr(args, 'model_hash', None):
+            raise RuntimeError("{0} holds the features of another model, remove the features of {1} from {2}".format(
+                fname, args.dataset_name, args.temp_dir))
+        return
+    features = load_multiscale_features([get_features_fname(args, S, part, name) for S in get_scales(args)])
+    save_descriptors(fname, features, ids, dataset=args.dataset_name, part=part, head=name or 'L{0}'.format(args.L),
+                     S=get_scales(args), L=args.L, multires=args.multires, model_hash=getattr(args, 'model_hash', None))
+
+
+def load_features(args, part, name=None):
+    # Multiresolution features of a head, memory-mapped from their
+    # descriptor store
+    return DescriptorStore(get_store_fname(args, part, name)).features
+
+
+def extract_features(dataset, image_helper, net, args, heads=None):
+    # Extracts the features of all the heads, returns those of the first one
+    heads = heads or get_heads(args)
+    Ss = get_scales(args)
     # First part, queries
-    for S in Ss:
-        # Set the scale of the image helper
-        image_helper.S = S
-        out_queries_fname = "{0}/{1}_S{2}_L{3}_queries.npy".format(args.temp_dir, args.dataset_name, S, args.L)
-        if not os.path.exists(out_queries_fname):
-            dim_features = 2048
-            N_queries = dataset.N_queries
-            features_queries = np.zeros((N_queries, dim_features), dtype=np.float32)
-            for i in tqdm(range(N_queries), file=sys.stdout, leave=False, dynamic_ncols=True):
-                # Load image, process image, get image regions, feed into the network, get descriptor, and store
-                I, R = image_helper.prepare_image_and_grid_regions_for_network(dataset.get_query_filename(i), roi=dataset.get_query_roi(i))
-                features_queries[i] = image_helper.get_rmac_features(I, R, net).detach().numpy()
-            np.save(out_queries_fname, features_queries)
-    features_queries = np.dstack([np.load("{0}/{1}_S{2}_L{3}_queries.npy".format(args.temp_dir, args.dataset_name, S, args.L)) for S in Ss]).sum(axis=2)
-    features_queries /= np.sqrt((features_queries * features_queries).sum(axis=1))[:, None]
+    N_queries = dataset.N_queries
+    fnames = [dataset.get_query_filename(i) for i in range(N_queries)]
+    rois = [dataset.get_query_roi(i) for i in range(N_queries)]
+    with metrics.stage('extract_queries'):
+        extract_scales(image_helper, net, fnames, rois, Ss, heads, 'queries', args)
+    with metrics.stage('load_features'):
+        for head in heads:
+            save_features(args, 'queries', head[0], dataset.q_names)
+        features_queries = load_features(args, 'queries', heads[0][0])
 
     # Second part, dataset
-    for S in Ss:
-        image_helper.S = S
-        out_dataset_fname = "{0}/{1}_S{2}_L{3}_dataset.npy".format(args.temp_dir, args.dataset_name, S, args.L)
-        if not os.path.exists(out_dataset_fname):
-            # dim_features = net.blobs['rmac/normalized'].data.shape[1]
-            dim_features = 2048
-            N_dataset = dataset.N_images
-            features_dataset = np.zeros((N_dataset, dim_features), dtype=np.float32)
-            for i in tqdm(range(N_dataset), file=sys.stdout, leave=False, dynamic_ncols=True):
-                # Load image, process image, get image regions, feed into the network, get descriptor, and store
-                I, R = image_helper.prepare_image_and_grid_regions_for_network(dataset.get_filename(i), roi=None)
-                features_dataset[i] = image_helper.get_rmac_features(I, R, net).detach().numpy()
-            np.save(out_dataset_fname, features_dataset)
-    features_dataset = np.dstack([np.load("{0}/{1}_S{2}_L{3}_dataset.npy".format(args.temp_dir, args.dataset_name, S, args.L)) for S in Ss]).sum(axis=2)
-    features_dataset /= np.sqrt((features_dataset * features_dataset).sum(axis=1))[:, None]
-    # Restore the original scale
-    image_helper.S = args.S
+    # dim_features = net.blobs['rmac/normalized'].data.shape[1]
+    N_dataset = dataset.N_images
+    fnames = [dataset.get_filename(i) for i in range(N_dataset)]
+    with metrics.stage('extract_dataset'):
+        extract_scales(image_helper, net, fnames, [None] * N_dataset, Ss, heads, 'dataset', args)
+    with metrics.stage('load_features'):
+        for head in heads:
+            save_features(args, 'dataset', head[0], dataset.img_filenames)
+        features_dataset = load_features(args, 'dataset', heads[0][0])
     return features_queries, features_dataset
 
 
+def database_dbe(features_dataset, dbe, memory_budget=2**30, num_threads=1):
+    # Extend the database features
+    # The neighbors are searched by tiles of the similarity matrix of at most
+    # memory_budget bytes, over num_threads shards of the database
+    with metrics.stage('dbe_search'):
+        _, idx = search(features_dataset, features_dataset, dbe + 1, memory_budget, num_threads)
+    with metrics.stage('dbe_average'):
+        weights = np.hstack(([1], (dbe - np.arange(0, dbe)) / float(dbe)))
+        weights_sum = weights.sum()
+        return np.vstack([np.dot(weights, features_dataset[idx[i, :dbe + 1], :]) / weights_sum for i in range(len(features_dataset))])
+
+
+def average_query_expansion(features_queries, features_dataset, sim, aqe):
+    # Sort the results to get the nearest neighbors, compute average
+    # representations, and query again.
+    # No need to L2-normalize as we are on the query side, so it doesn't
+    # affect the ranking
+    with metrics.stage('aqe_topk'):
+        idx = top_k(sim, aqe)
+    with metrics.stage('aqe_average'):
+        features_queries = np.vstack([np.vstack((features_queries[i], features_dataset[idx[i, :aqe]])).mean(axis=0) for i in range(len(features_queries))])
+    #for i in range(features_queries.shape[0]):
+    #    features_queries[i] = np.vstack((features_queries[i], features_dataset[idx[i, :aqe]])).mean(axis=0)
+    with metrics.stage('similarity'):
+        sim = features_queries.dot(features_dataset.T)
+    return features_queries, sim
+
+
+def search_and_score(dataset, features_queries, features_dataset, args):
+    # Database side expansion?
+    if args.dbe is not None and args.dbe > 0:
+        features_dataset = database_dbe(features_dataset, args.dbe, int(getattr(args, 'search_memory', 1) * 2**30),
+                                        getattr(args, 'search_threads', 1))
+
+    # Compute similarity
+    with metrics.stage('similarity'):
+        sim = features_queries.dot(features_dataset.T)
+    # Average query expansion?
+    if args.aqe is not None and args.aqe > 0:
+        features_queries, sim = average_query_expansion(features_queries, features_dataset, sim, args.aqe)
+
+    # Score
+    with metrics.stage('score'):
+        return dataset.score(sim, args.temp_dir, args.eval_binary)
+
+
+def evaluate_quantization(dataset, image_helper, net, features_queries, features_dataset, map_float, args):
+    # Static int8 backbone calibrated on the first database images, dynamic
+    # int8 PCA. Reports the CPU throughput and the serialized size against
+    # the float model, the cosine drift of the descriptors and the mAP change.
+    torch.backends.quantized.engine = 'x86'
+    float_net = copy.deepcopy(net).cpu().eval()
+    float_helper = copy.copy(image_helper)
+    float_helper.device = 'cpu'
+    float_helper.rmac_head = copy.deepcopy(image_helper.rmac_head).cpu()
+    int8_helper = copy.copy(float_helper)
+    int8_helper.rmac_head = quantize_rmac_head(image_helper.rmac_head)
+    # The cached feature maps are those of the float network
+    int8_helper.feature_cache = None
+
+    sample = [image_helper.prepare_image_and_grid_regions_for_network(dataset.get_filename(i), roi=None)
+              for i in range(min(args.quantize, dataset.N_images))]
+    # The int8 backbone and its features depend on the calibration images
+    # and on the float model
+    int8_tag = "_int8_q{0}_{1}".format(args.quantize, getattr(args, 'model_hash', None))
+    quantized_model = args.quantized_model or "{0}/{1}_S{2}{3}.pt".format(args.temp_dir, args.dataset_name, args.S, int8_tag)
+    if os.path.exists(quantized_model):
+        int8_net = torch.jit.load(quantized_model)
+    else:
+        with torch.no_grad():
+            int8_net = quantize_backbone(float_net, [torch.from_numpy(I) for I, _ in sample])
+            int8_net = torch.jit.trace(int8_net, torch.from_numpy(sample[0][0]))
+        torch.jit.save(int8_net, quantized_model)
+
+    speed = {}
+    for name, helper, model in (('float', float_helper, float_net), ('int8', int8_helper, int8_net)):
+        with torch.no_grad():
+            # A loaded TorchScript model is only optimized after a few runs
+            for _ in range(3):
+                helper.get_rmac_features(sample[0][0], sample[0][1], model)
+            start = time.time()
+            for I, R in sample:
+                helper.get_rmac_features(I, R, model)
+        speed[name] = len(sample) / (time.time() - start)
+    buf = io.BytesIO()
+    torch.save(float_net.state_dict(), buf)
+    float_size = buf.tell() + os.path.getsize('weights/pca_weight.npy')
+    buf = io.BytesIO()
+    torch.save(int8_helper.rmac_head.state_dict(), buf)
+    int8_size = os.path.getsize(quantized_model) + buf.tell()
+
+    int8_args = argparse.Namespace(**dict(vars(args), features_tag=getattr(args, 'features_tag', '') + int8_tag))
+    with torch.no_grad():
+        int8_queries, int8_dataset = extract_features(dataset, int8_helper, int8_net, int8_args, get_heads(args)[:1])
+    cosine = np.hstack(((features_queries * int8_queries).sum(axis=1), (features_dataset * int8_dataset).sum(axis=1)))
+    map_int8 = search_and_score(dataset, int8_queries, int8_dataset, int8_args)
+
+    print (20 * "-")
+    print ("CPU throughput: float {0:.2f} images/s, int8 {1:.2f} images/s ({2:.2f}x)".format(speed['float'], speed['int8'], speed['int8'] / speed['float']))
+    print ("Model size: float {0:.1f} MB, int8 {1:.1f} MB ({2:.2f}x smaller)".format(float_size / 2.0**20, int8_size / 2.0**20, float(float_size) / int8_size))
+    print ("Cosine to the float descriptors: mean {0:.4f}, min {1:.4f}".format(cosine.mean(), cosine.min()))
+    print ("mAP: float {0:.2f}, int8 {1:.2f} ({2:+.2f})".format(100 * map_float, 100 * map_int8, 100 * (map_int8 - map_float)))
+
+
+def evaluate_product_quantization(dataset, features_queries, features_dataset, args):
+    # Product quantization codes of the database, re-ranked with the float
+    # descriptors memory-mapped from their store. Reports the memory of the
+    # codes against the float descriptors, and the recall@100 and the mAP
+    # of the search of the codes, without and with re-ranking, against the
+    # exhaustive search. DBE and AQE are left out.
+    pq_fname = "{0}_pq{1}{2}.rdesc".format(get_store_fname(args, 'dataset', get_heads(args)[0][0])[:-len('.rdesc')], args.pq,
+                                           '_opq' if args.opq else '')
+    # An index of other descriptors (another model, or another dataset of
+    # the same size) is rebuilt
+    model_hash = getattr(args, 'model_hash', None)
+    if is_current_store(pq_fname, len(features_dataset), model_hash=model_hash):
+        index = load_pq_index(pq_fname, features_dataset)
+    else:
+        index = build_pq_index(pq_fname, features_dataset, args.pq, args.opq, dataset=args.dataset_name, model_hash=model_hash)
+    quantizer = index.quantizer
+    codes_bytes = index.codes.nbytes + quantizer.codebooks.nbytes + (quantizer.rotation.nbytes if quantizer.rotation is not None else 0)
+
+    # compute_ap needs the whole ranking, scored by decreasing rank
+    def score(idx):
+        ranks = np.empty(idx.shape, dtype=np.float32)
+        np.put_along_axis(ranks, idx, -np.arange(idx.shape[1], dtype=np.float32)[None], axis=1)
+        return dataset.score(ranks, args.temp_dir, args.eval_binary)
+
+    exact_idx = search(features_queries, features_dataset, len(features_dataset))[1]
+    map_exact = score(exact_idx)
+    results = []
+    for rerank in (0, args.rerank):
+        idx = index.search(features_queries, len(features_dataset), rerank)[1]
+        results.append((rerank, recall_at_k(idx[:, :100], exact_idx[:, :100]), score(idx)))
+
+    print (20 * "-")
+    print ("PQ codes: {0} bytes{1}, {2:.2f} MB instead of {3:.2f} MB of float descriptors ({4:.1f}x smaller)".format(
+        args.pq, ' OPQ' if args.opq else '', codes_bytes / 2.0**20, features_dataset.nbytes / 2.0**20, float(features_dataset.nbytes) / codes_bytes))
+    for rerank, recall, map_ in results:
+        print ("Re-ranking {0}: recall@100 {1:.4f}, mAP {2:.2f} ({3:+.2f})".format(rerank, recall, 100 * map_, 100 * (map_ - map_exact)))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Evaluate Oxford / Paris')
     parser.add_argument('--gpu', type=int, required=False, help='GPU ID to use (e.g. 0)')
@@ -323,11 +679,42 @@ if __name__ == '__main__':
     parser.add_argument('--multires', dest='multires', action='store_true', help='Enable multiresolution features')
     parser.add_argument('--aqe', type=int, required=False, help='Average query expansion with k neighbors')
     parser.add_argument('--dbe', type=int, required=False, help='Database expansion with k neighbors')
-    parser.set_defaults(multires=False)
+    parser.add_argument('--search_memory', type=float, default=1, help='Memory in GB of the tiles of similarities of the nearest neighbor searches')
+    parser.add_argument('--search_threads', type=int, default=1, help='Search the database in this many shards in parallel, each thread with its share of the intra-op threads')
+    parser.add_argument('--batch_size', type=int, default=1, help='Number of images of the same size per forward pass')
+    parser.add_argument('--batch_pad', type=int, default=0, help='Batch images whose sizes match once padded to a multiple of this (0: exact sizes only)')
+    parser.add_argument('--workers', type=int, default=0, help='Number of processes loading and resizing images (0: load in the main process)')
+    parser.add_argument('--prefetch', type=int, default=16, help='Maximum number of images loaded ahead of the network')
+    parser.add_argument('--fast_decode', dest='fast_decode', action='store_true', help='Decode the JPEGs at 1/2, 1/4 or 1/8 of their size when that is still larger than S')
+    parser.add_argument('--image_cache', type=str, required=False, help='Directory of a persistent cache of the resized images, shared by later runs')
+    parser.add_argument('--image_cache_size', type=float, default=50, help='Maximum size of the image cache in GB')
+    parser.add_argument('--feature_cache', type=str, required=False, help='Directory of a persistent cache of the float16 res5c feature maps, to pool them again for other L')
+    parser.add_argument('--feature_cache_size', type=float, default=200, help='Maximum size of the feature map cache in GB')
+    parser.add_argument('--repool', dest='repool', action='store_true', help='Only pool the feature maps of the --feature_cache, without loading the network')
+    parser.add_argument('--heads', type=parse_heads, required=False, help='Comma separated descriptors computed from the same forward pass, among rmacL, mac, spoc and gemP (default: the R-MAC of --L)')
+    parser.add_argument('--chunk_size', type=int, default=10000, help='Save the features every this many images, an interrupted extraction resumes from the last chunk (0: only at the end)')
+    parser.add_argument('--quantize', type=int, required=False, help='Also evaluate an int8 model calibrated on this many database images')
+    parser.add_argument('--quantized_model', type=str, required=False, help='Path of the int8 backbone, created if it does not exist')
+    parser.add_argument('--pq', type=int, required=False, help='Also evaluate product quantization codes of this many bytes per image (e.g. 64 to 256)')
+    parser.add_argument('--opq', type=int, default=0, help='Learn the rotation of OPQ in this many iterations before the --pq codebooks (0: plain PQ)')
+    parser.add_argument('--rerank', type=int, default=1000, help='Re-rank this many --pq candidates of each query with the float descriptors')
+    parser.add_argument('--export', type=str, required=False, help='Save the network and the R-MAC head as a single descriptor model to this path, then exit')
+    parser.add_argument('--model', type=str, required=False, help='Exported descriptor model to use instead of the pytorch/ network and the PCA files')
+    parser.add_argument('--metrics', type=str, required=False, help='Time each stage of the extraction and search, and save the counts, times and latency histograms to this file at the end')
+    parser.add_argument('--metrics_format', type=str, default='json', choices=['json', 'prometheus'], help='Format of the --metrics file')
+    parser.set_defaults(multires=False, fast_decode=False, repool=False)
     args = parser.parse_args()
+    if args.model and (args.quantize or args.export or args.feature_cache):
+        parser.error('--quantize, --export and --feature_cache need the original network, they cannot be used with --model')
+    if args.model and any(pooling != 'rmac' for _, pooling, _ in get_heads(args)):
+        parser.error('Exported models only compute R-MAC and MAC descriptors')
+    if args.repool and (not args.feature_cache or args.quantize or args.export):
+        parser.error('--repool needs --feature_cache, and cannot be used with --quantize or --export')
 
     if not os.path.exists(args.temp_dir):
         os.makedirs(args.temp_dir)
+    if args.metrics:
+        metrics.enable()
 
     # Load and reshape the means to subtract to the inputs
     args.means = np.array([103.93900299,  116.77899933,  123.68000031], dtype=np.float32)[None, :, None, None]
@@ -338,45 +725,73 @@ if __name__ == '__main__':
     # caffe.set_mode_gpu()
     # net = caffe.Net(args.proto, args.weights, caffe.TEST)
 
-    MainModel = imp.load_source('MainModel', 'pytorch/pytorch_resnet101.py')
-
-    net = torch.load('pytorch/pytorch_resnet101.pth')
-    net.eval()
-    net = net.cuda()
+    if args.repool:
+        # Everything comes from the feature cache
+        net = None
+        image_helper = ImageHelper(args.S, args.L, args.means)
+    elif args.model:
+        start = time.time()
+        image_helper = ImageHelper(args.S, args.L, args.means, load_head=False)
+        net = load_descriptor_model(args.model, image_helper.device)
+        print ("Loaded {0} in {1:.3f}s".format(args.model, time.time() - start))
+    else:
+        MainModel = imp.load_source('MainModel', 'pytorch/pytorch_resnet101.py')
+
+        net = torch.load('pytorch/pytorch_resnet101.pth')
+        net.eval()
+        net = net.cuda()
+        image_helper = ImageHelper(args.S, args.L, args.means)
+
+    if args.export:
+        example = torch.zeros((1, 3, args.S, args.S))
+        export_descriptor_model(net, image_helper.rmac_head, example, args.export)
+        print ("Saved the descriptor model to {0}".format(args.export))
+        sys.exit(0)
+
+    # Recorded in the descriptor stores
+    args.model_hash = file_hash([args.model] if args.model else
+                                ['pytorch/pytorch_resnet101.pth', 'weights/pca_weight.npy', 'weights/pca_bias.npy', 'centered2.npy'])
+
+    # Reduced decoding changes the descriptors a little, they are cached
+    # separately
+    image_helper.fast_decode = args.fast_decode
+    args.features_tag = '_fastdecode' if args.fast_decode else ''
+    if args.image_cache:
+        image_helper.image_cache = ArrayCache(args.image_cache, np.uint8, max_bytes=int(args.image_cache_size * 2**30))
+        cache_stats = image_helper.image_cache.stats()
+    if args.feature_cache:
+        # Descriptors are pooled from the float16 maps
+        image_helper.feature_cache = ArrayCache(args.feature_cache, np.float16, max_bytes=int(args.feature_cache_size * 2**30))
+        image_helper.backbone_hash = file_hash(['pytorch/pytorch_resnet101.pth'])
+        args.features_tag += '_f16maps'
 
     pdb.set_trace()
-    # Load the dataset and the image helper
+    # Load the dataset
     dataset = Dataset(args.dataset, args.eval_binary)
-    image_helper = ImageHelper(args.S, args.L, args.means)
 
     # Extract features
     features_queries, features_dataset = extract_features(dataset, image_helper, net, args)
-
-    # Database side expansion?
-    if args.dbe is not None and args.dbe > 0:
-        # Extend the database features
-        # With larger datasets this has to be done in a batched way.
-        # and using smarter ways than sorting to take the top k results.
-        # For 5k images, not really a problem to do it by brute force
-        X = features_dataset.dot(features_dataset.T)
-        idx = np.argsort(X, axis=1)[:, ::-1]
-        weights = np.hstack(([1], (args.dbe - np.arange(0, args.dbe)) / float(args.dbe)))
-        weights_sum = weights.sum()
-        features_dataset = np.vstack([np.dot(weights, features_dataset[idx[i, :args.dbe + 1], :]) / weights_sum for i in range(len(features_dataset))])
-
-    # Compute similarity
-    sim = features_queries.dot(features_dataset.T)
-    # Average query expansion?
-    if args.aqe is not None and args.aqe > 0:
-        # Sort the results to get the nearest neighbors, compute average
-        # representations, and query again.
-        # No need to L2-normalize as we are on the query side, so it doesn't
-        # affect the ranking
-        idx = np.argsort(sim, axis=1)[:, ::-1]
-        features_queries = np.vstack([np.vstack((features_queries[i], features_dataset[idx[i, :args.aqe]])).mean(axis=0) for i in range(len(features_queries))])
-        #for i in range(features_queries.shape[0]):
-        #    features_queries[i] = np.vstack((features_queries[i], features_dataset[idx[i, :args.aqe]])).mean(axis=0)
-        sim = features_queries.dot(features_dataset.T)
-
-    # Score
-    dataset.score(sim, args.temp_dir, args.eval_binary)
+    if args.image_cache:
+        stats = image_helper.image_cache.stats()
+        hits, misses = stats['hits'] - cache_stats['hits'], stats['misses'] - cache_stats['misses']
+        print ("Image cache: {0} hits, {1} misses ({2:.1f}% hit rate), {3} images in {4:.2f} GB".format(
+            hits, misses, 100.0 * hits / max(hits + misses, 1), stats['arrays'], stats['bytes'] / 2.0**30))
+
+    # Search and score
+    heads = get_heads(args)
+    if len(heads) > 1:
+        print ("Head {0}".format(heads[0][0]))
+    map_ = search_and_score(dataset, features_queries, features_dataset, args)
+    for head in heads[1:]:
+        print ("Head {0}".format(head[0]))
+        search_and_score(dataset, load_features(args, 'queries', head[0]), load_features(args, 'dataset', head[0]), args)
+
+    if args.pq:
+        evaluate_product_quantization(dataset, features_queries, features_dataset, args)
+
+    if args.quantize:
+        evaluate_quantization(dataset, image_helper, net, features_queries, features_dataset, map_, args)
+
+    if args.metrics:
+        metrics.dump(args.metrics, args.metrics_format)
+        print ("Saved the metrics to {0}".format(args.metrics))
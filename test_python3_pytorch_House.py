@@ -6,6 +6,10 @@ from torch.autograd import Variable
 from Common import L2Normalization
 from Common import Shift
 from Common import RoIPool
+from Common import get_rmac_region_coordinates
+from Common import load_multiscale_features
+from Common import top_k
+from Common import search
 
 import imp
 import sys
@@ -116,57 +120,7 @@ class ImageHelper:
         return R
 
     def get_rmac_region_coordinates(self, H, W, L):
-        # Almost verbatim from Tolias et al Matlab implementation.
-        # Could be heavily pythonized, but really not worth it...
-        # Desired overlap of neighboring regions
-        ovr = 0.4
-        # Possible regions for the long dimension
-        steps = np.array((2, 3, 4, 5, 6, 7), dtype=np.float32)
-        w = np.minimum(H, W)
-
-        b = (np.maximum(H, W) - w) / (steps - 1)
-        # steps(idx) regions for long dimension. The +1 comes from Matlab
-        # 1-indexing...
-        idx = np.argmin(np.abs(((w**2 - w * b) / w**2) - ovr)) + 1
-
-        # Region overplus per dimension
-        Wd = 0
-        Hd = 0
-        if H < W:
-            Wd = idx
-        elif H > W:
-            Hd = idx
-
-        regions_xywh = []
-        for l in range(1, L+1):
-            wl = np.floor(2 * w / (l + 1))
-            wl2 = np.floor(wl / 2 - 1)
-            # Center coordinates
-            if l + Wd - 1 > 0:
-                b = (W - wl) / (l + Wd - 1)
-            else:
-                b = 0
-            cenW = np.floor(wl2 + b * np.arange(l - 1 + Wd + 1)) - wl2
-            # Center coordinates
-            if l + Hd - 1 > 0:
-                b = (H - wl) / (l + Hd - 1)
-            else:
-                b = 0
-            cenH = np.floor(wl2 + b * np.arange(l - 1 + Hd + 1)) - wl2
-
-            for i_ in cenH:
-                for j_ in cenW:
-                    regions_xywh.append([j_, i_, wl, wl])
-
-        # Round the regions. Careful with the borders!
-        for i in range(len(regions_xywh)):
-            for j in range(4):
-                regions_xywh[i][j] = int(round(regions_xywh[i][j]))
-            if regions_xywh[i][0] + regions_xywh[i][2] > W:
-                regions_xywh[i][0] -= ((regions_xywh[i][0] + regions_xywh[i][2]) - W)
-            if regions_xywh[i][1] + regions_xywh[i][3] > H:
-                regions_xywh[i][1] -= ((regions_xywh[i][1] + regions_xywh[i][3]) - H)
-        return np.array(regions_xywh).astype(np.float32)
+        return get_rmac_region_coordinates(H, W, L)
 
 
 class Dataset:
@@ -201,7 +155,8 @@ class Dataset:
     def score(self, sim, temp_dir):
         if not os.path.exists(temp_dir):
             os.makedirs(temp_dir)
-        idx = np.argsort(sim, axis=1)[:, ::-1]
+        # The .rnk files hold the whole ranking
+        idx = top_k(sim, sim.shape[1])
         ls_top1 = []
         ls_top10 = []
         for i in range(len(self.query_imagenames)):
@@ -271,8 +226,7 @@ def extract_features(dataset, image_helper, net, args):
                 I, R = image_helper.prepare_image_and_grid_regions_for_network(dataset.get_query_filename(i), roi=None)
                 features_queries[i] = image_helper.get_rmac_features(I, R, net).detach().numpy()
             np.save(out_queries_fname, features_queries)
-    features_queries = np.dstack([np.load("{0}/{1}_S{2}_L{3}_queries.npy".format(args.temp_dir, args.dataset_name, S, args.L)) for S in Ss]).sum(axis=2)
-    features_queries /= np.sqrt((features_queries * features_queries).sum(axis=1))[:, None]
+    features_queries = load_multiscale_features(["{0}/{1}_S{2}_L{3}_queries.npy".format(args.temp_dir, args.dataset_name, S, args.L) for S in Ss])
 
     # Second part, dataset
     for S in Ss:
@@ -288,8 +242,7 @@ def extract_features(dataset, image_helper, net, args):
                 I, R = image_helper.prepare_image_and_grid_regions_for_network(dataset.get_filename(i), roi=None)
                 features_dataset[i] = image_helper.get_rmac_features(I, R, net).detach().numpy()
             np.save(out_dataset_fname, features_dataset)
-    features_dataset = np.dstack([np.load("{0}/{1}_S{2}_L{3}_dataset.npy".format(args.temp_dir, args.dataset_name, S, args.L)) for S in Ss]).sum(axis=2)
-    features_dataset /= np.sqrt((features_dataset * features_dataset).sum(axis=1))[:, None]
+    features_dataset = load_multiscale_features(["{0}/{1}_S{2}_L{3}_dataset.npy".format(args.temp_dir, args.dataset_name, S, args.L) for S in Ss])
     # Restore the original scale
     image_helper.S = args.S
     return features_queries, features_dataset
@@ -309,6 +262,8 @@ if __name__ == '__main__':
     parser.add_argument('--multires', dest='multires', action='store_true', help='Enable multiresolution features')
     parser.add_argument('--aqe', type=int, required=False, help='Average query expansion with k neighbors')
     parser.add_argument('--dbe', type=int, required=False, help='Database expansion with k neighbors')
+    parser.add_argument('--search_memory', type=float, default=1, help='Memory in GB of the tiles of similarities of the nearest neighbor searches')
+    parser.add_argument('--search_threads', type=int, default=1, help='Search the database in this many shards in parallel, each thread with its share of the intra-op threads')
     parser.set_defaults(multires=False)
     args = parser.parse_args()
 
@@ -343,11 +298,9 @@ if __name__ == '__main__':
     # Database side expansion?
     if args.dbe is not None and args.dbe > 0:
         # Extend the database features
-        # With larger datasets this has to be done in a batched way.
-        # and using smarter ways than sorting to take the top k results.
-        # For 5k images, not really a problem to do it by brute force
-        X = features_dataset.dot(features_dataset.T)
-        idx = np.argsort(X, axis=1)[:, ::-1]
+        # The neighbors are searched by tiles of the similarity matrix of at
+        # most --search_memory
+        _, idx = search(features_dataset, features_dataset, args.dbe + 1, int(args.search_memory * 2**30), args.search_threads)
         weights = np.hstack(([1], (args.dbe - np.arange(0, args.dbe)) / float(args.dbe)))
         weights_sum = weights.sum()
         features_dataset = np.vstack([np.dot(weights, features_dataset[idx[i, :args.dbe + 1], :]) / weights_sum for i in range(len(features_dataset))])
@@ -360,7 +313,7 @@ if __name__ == '__main__':
         # representations, and query again.
         # No need to L2-normalize as we are on the query side, so it doesn't
         # affect the ranking
-        idx = np.argsort(sim, axis=1)[:, ::-1]
+        idx = top_k(sim, args.aqe)
         features_queries = np.vstack([np.vstack((features_queries[i], features_dataset[idx[i, :args.aqe]])).mean(axis=0) for i in range(len(features_queries))])
         #for i in range(features_queries.shape[0]):
         #    features_queries[i] = np.vstack((features_queries[i], features_dataset[idx[i, :args.aqe]])).mean(axis=0)
@@ -5,7 +5,19 @@ from torch.autograd import Variable
 
 from Common import L2Normalization
 from Common import Shift
+from Common import DescriptorStore
 from Common import RoIPool
+from Common import build_ivf_index
+from Common import build_pq_index
+from Common import file_hash
+from Common import get_rmac_region_coordinates
+from Common import is_current_store
+from Common import load_ivf_index
+from Common import load_multiscale_features
+from Common import load_pq_index
+from Common import recall_at_k
+from Common import save_descriptors
+from Common import search
 
 import imp
 import sys
@@ -20,6 +32,9 @@ import pdb
 import re
 import time
 
+# Queries searched, named and written at a time
+NUM_CONSTANT = 500
+
 class ImageHelper:
     def __init__(self, S, L, means):
         self.S = S
@@ -125,57 +140,7 @@ class ImageHelper:
         return R
 
     def get_rmac_region_coordinates(self, H, W, L):
-        # Almost verbatim from Tolias et al Matlab implementation.
-        # Could be heavily pythonized, but really not worth it...
-        # Desired overlap of neighboring regions
-        ovr = 0.4
-        # Possible regions for the long dimension
-        steps = np.array((2, 3, 4, 5, 6, 7), dtype=np.float32)
-        w = np.minimum(H, W)
-
-        b = (np.maximum(H, W) - w) / (steps - 1)
-        # steps(idx) regions for long dimension. The +1 comes from Matlab
-        # 1-indexing...
-        idx = np.argmin(np.abs(((w**2 - w * b) / w**2) - ovr)) + 1
-
-        # Region overplus per dimension
-        Wd = 0
-        Hd = 0
-        if H < W:
-            Wd = idx
-        elif H > W:
-            Hd = idx
-
-        regions_xywh = []
-        for l in range(1, L+1):
-            wl = np.floor(2 * w / (l + 1))
-            wl2 = np.floor(wl / 2 - 1)
-            # Center coordinates
-            if l + Wd - 1 > 0:
-                b = (W - wl) / (l + Wd - 1)
-            else:
-                b = 0
-            cenW = np.floor(wl2 + b * np.arange(l - 1 + Wd + 1)) - wl2
-            # Center coordinates
-            if l + Hd - 1 > 0:
-                b = (H - wl) / (l + Hd - 1)
-            else:
-                b = 0
-            cenH = np.floor(wl2 + b * np.arange(l - 1 + Hd + 1)) - wl2
-
-            for i_ in cenH:
-                for j_ in cenW:
-                    regions_xywh.append([j_, i_, wl, wl])
-
-        # Round the regions. Careful with the borders!
-        for i in range(len(regions_xywh)):
-            for j in range(4):
-                regions_xywh[i][j] = int(round(regions_xywh[i][j]))
-            if regions_xywh[i][0] + regions_xywh[i][2] > W:
-                regions_xywh[i][0] -= ((regions_xywh[i][0] + regions_xywh[i][2]) - W)
-            if regions_xywh[i][1] + regions_xywh[i][3] > H:
-                regions_xywh[i][1] -= ((regions_xywh[i][1] + regions_xywh[i][3]) - H)
-        return np.array(regions_xywh).astype(np.float32)
+        return get_rmac_region_coordinates(H, W, L)
 
 
 class Dataset:
@@ -201,31 +166,35 @@ class Dataset:
         self.N_images = len(self.index_imagenames)
         self.N_queries = len(self.query_imagenames)
 
-    def score(self, features_queries, features_dataset, aqe, temp_dir):
+    def score(self, features_queries, features_dataset, aqe, temp_dir, memory_budget=2**30, num_threads=1, index_search=None):
         if not os.path.exists(temp_dir):
             os.makedirs(temp_dir)
 
         # time_str = time.strftime("%Y-%m-%d", time.localtime())
 
+        # NUM_CONSTANT queries at a time, each block searched by tiles of the
+        # similarity matrix of at most memory_budget bytes, over num_threads
+        # shards of the database, or by index_search(queries, k), the indices
+        # of the neighbors in an approximate index
+        def neighbors(queries, k):
+            if index_search is not None:
+                return index_search(queries, k)
+            return search(queries, features_dataset, k, memory_budget, num_threads)[1]
+
+        # Names without extension of the database images
+        index_names = np.array([file.split('.')[0] for file in self.index_imagenames])
         fw = open("{0}/submit_QE{1}.csv".format(temp_dir, aqe), 'w')
         fw.write("id,images\n")
-
-        for i in tqdm(range(len(self.query_imagenames)), file=sys.stdout, leave=False, dynamic_ncols=True):
-            sim = np.reshape(features_queries[i,:], (1, 2048)).dot(features_dataset.T)
-            idx = np.argsort(sim, axis=1)[:, ::-1]
-
+        for start in tqdm(range(0, len(self.query_imagenames), NUM_CONSTANT), file=sys.stdout, leave=False, dynamic_ncols=True):
+            features_query = features_queries[start:start + NUM_CONSTANT]
+            # The probed lists of an IVF index may hold fewer than k images,
+            # whose missing neighbors are -1
             if aqe is not None and aqe > 0:
-                features_query = np.vstack((features_queries[i].reshape(1, 2048), features_dataset[idx[0, :args.aqe]])).mean(axis=0)
-                sim = np.reshape(features_query, (1, 2048)).dot(features_dataset.T)
-                idx = np.argsort(sim, axis=1)[:, ::-1]
-
-            rnk = np.array(self.index_imagenames)[idx]
-            rnk_100 = rnk[0, :100]
-            rnk_100_final = [file.split('.')[0] for file in rnk_100]
-            # with open("{0}/{1}.rnk".format(temp_dir, self.q_names[i]), 'w') as f:
-            #     f.write(" ".join(rnk_100_final) + "\n")
-            result_line = self.q_names[i] + ',' + " ".join(rnk_100_final) + "\n"
-            fw.write(result_line)
+                idx = neighbors(features_query, aqe)
+                features_query = np.vstack([np.vstack((features_query[i].reshape(1, 2048), features_dataset[idx[i][idx[i] >= 0]])).mean(axis=0) for i in range(len(features_query))])
+            idx = neighbors(features_query, 100)
+            rnk_100 = index_names[idx]
+            fw.writelines(self.q_names[start + i] + ',' + " ".join(rnk_100[i][idx[i] >= 0]) + "\n" for i in range(len(idx)))
         fw.close()
         return
 
@@ -252,8 +221,7 @@ def extract_features(dataset, image_helper, net, args):
                 I, R = image_helper.prepare_image_and_grid_regions_for_network(dataset.get_query_filename(i), roi=None)
                 features_queries[i] = image_helper.get_rmac_features(I, R, net).detach().numpy()
             np.save(out_queries_fname, features_queries)
-    features_queries = np.dstack([np.load("{0}/{1}_S{2}_L{3}_queries.npy".format(args.temp_dir, args.dataset_name, S, args.L)) for S in Ss]).sum(axis=2)
-    features_queries /= np.sqrt((features_queries * features_queries).sum(axis=1))[:, None]
+    features_queries = load_multiscale_features(["{0}/{1}_S{2}_L{3}_queries.npy".format(args.temp_dir, args.dataset_name, S, args.L) for S in Ss])
 
     # Second part, dataset
     for S in Ss:
@@ -269,8 +237,7 @@ def extract_features(dataset, image_helper, net, args):
                 I, R = image_helper.prepare_image_and_grid_regions_for_network(dataset.get_filename(i), roi=None)
                 features_dataset[i] = image_helper.get_rmac_features(I, R, net).detach().numpy()
             np.save(out_dataset_fname, features_dataset)
-    features_dataset = np.dstack([np.load("{0}/{1}_S{2}_L{3}_dataset.npy".format(args.temp_dir, args.dataset_name, S, args.L)) for S in Ss]).sum(axis=2)
-    features_dataset /= np.sqrt((features_dataset * features_dataset).sum(axis=1))[:, None]
+    features_dataset = load_multiscale_features(["{0}/{1}_S{2}_L{3}_dataset.npy".format(args.temp_dir, args.dataset_name, S, args.L) for S in Ss])
     # Restore the original scale
     image_helper.S = args.S
     return features_queries, features_dataset
@@ -290,8 +257,18 @@ if __name__ == '__main__':
     parser.add_argument('--multires', dest='multires', action='store_true', help='Enable multiresolution features')
     parser.add_argument('--aqe', type=int, required=False, help='Average query expansion with k neighbors')
     parser.add_argument('--dbe', type=int, required=False, help='Database expansion with k neighbors')
+    parser.add_argument('--search_memory', type=float, default=1, help='Memory in GB of the tiles of similarities of the nearest neighbor searches')
+    parser.add_argument('--search_threads', type=int, default=1, help='Search the database in this many shards in parallel, each thread with its share of the intra-op threads')
+    parser.add_argument('--ivf', type=int, required=False, help='Search an inverted file index of the database with this many lists (e.g. 4 * sqrt(#images)) instead of all of it')
+    parser.add_argument('--nprobe', type=int, default=16, help='Number of lists of the --ivf index searched for each query')
+    parser.add_argument('--pq', type=int, required=False, help='Search product quantization codes of this many bytes per image (e.g. 64 to 256) instead of the float descriptors')
+    parser.add_argument('--opq', type=int, default=0, help='Learn the rotation of OPQ in this many iterations before the --pq codebooks (0: plain PQ)')
+    parser.add_argument('--rerank', type=int, default=1000, help='Re-rank this many --pq candidates of each query with the float descriptors')
+    parser.add_argument('--index_report', dest='index_report', action='store_true', help='Report the recall@100 of the --ivf or --pq search against the exhaustive search, and its speedup')
     parser.set_defaults(multires=False)
     args = parser.parse_args()
+    if args.ivf and args.pq:
+        parser.error('--ivf and --pq are alternative indexes')
 
     if not os.path.exists(args.temp_dir):
         os.makedirs(args.temp_dir)
@@ -321,11 +298,9 @@ if __name__ == '__main__':
     # Database side expansion?
     if args.dbe is not None and args.dbe > 0:
         # Extend the database features
-        # With larger datasets this has to be done in a batched way.
-        # and using smarter ways than sorting to take the top k results.
-        # For 5k images, not really a problem to do it by brute force
-        X = features_dataset.dot(features_dataset.T)
-        idx = np.argsort(X, axis=1)[:, ::-1]
+        # The neighbors are searched by tiles of the similarity matrix of at
+        # most --search_memory
+        _, idx = search(features_dataset, features_dataset, args.dbe + 1, int(args.search_memory * 2**30), args.search_threads)
         weights = np.hstack(([1], (args.dbe - np.arange(0, args.dbe)) / float(args.dbe)))
         weights_sum = weights.sum()
         features_dataset = np.vstack([np.dot(weights, features_dataset[idx[i, :args.dbe + 1], :]) / weights_sum for i in range(len(features_dataset))])
@@ -343,5 +318,51 @@ if __name__ == '__main__':
     #     features_queries = np.vstack([np.vstack((features_queries[i], features_dataset[idx[i, :args.aqe]])).mean(axis=0) for i in range(len(features_queries))])
     #     sim = features_queries.dot(features_dataset.T)
 
+    # Approximate search in an inverted file or a product quantization
+    # index, saved next to the features. Those of another model (hash in
+    # their header) or of another number of images are rebuilt.
+    model_hash = file_hash(['pytorch/pytorch_resnet101.pth', 'weights/pca_weight.npy', 'weights/pca_bias.npy', 'centered2.npy'])
+    memory_budget = int(args.search_memory * 2**30)
+    index_prefix = "{0}/{1}_S{2}_L{3}{4}_dbe{5}".format(
+        args.temp_dir, args.dataset_name, args.S, args.L, '_multires' if args.multires else '', args.dbe or 0)
+    index, index_search = None, None
+    if args.ivf is not None and args.ivf > 0:
+        ivf_fname = "{0}_ivf{1}.rdesc".format(index_prefix, args.ivf)
+        if is_current_store(ivf_fname, len(features_dataset), model_hash=model_hash):
+            index = load_ivf_index(ivf_fname)
+        else:
+            index = build_ivf_index(ivf_fname, features_dataset, args.ivf, memory_budget=memory_budget, model_hash=model_hash)
+        index_search = lambda queries, k: index.search(queries, k, args.nprobe, memory_budget)[1]
+        index_name = "IVF {0} lists, nprobe {1}".format(args.ivf, args.nprobe)
+    elif args.pq is not None and args.pq > 0:
+        # The candidates are re-ranked with the full precision features,
+        # memory-mapped from their descriptor store, so that only the codes
+        # are held in memory
+        features_fname = index_prefix + '_features.rdesc'
+        if not is_current_store(features_fname, len(features_dataset), model_hash=model_hash):
+            save_descriptors(features_fname, features_dataset, dataset.index_imagenames, dataset=args.dataset_name, S=args.S, L=args.L,
+                             multires=args.multires, dbe=args.dbe or 0, model_hash=model_hash)
+        features_dataset = DescriptorStore(features_fname).features
+        pq_fname = "{0}_pq{1}{2}.rdesc".format(index_prefix, args.pq, '_opq' if args.opq else '')
+        if is_current_store(pq_fname, len(features_dataset), model_hash=model_hash):
+            index = load_pq_index(pq_fname, features_dataset)
+        else:
+            index = build_pq_index(pq_fname, features_dataset, args.pq, args.opq, model_hash=model_hash)
+        index_search = lambda queries, k: index.search(queries, k, args.rerank, memory_budget)[1]
+        index_name = "PQ {0} bytes{1}, rerank {2}".format(args.pq, ' OPQ' if args.opq else '', args.rerank)
+        quantizer = index.quantizer
+        codes_bytes = index.codes.nbytes + quantizer.codebooks.nbytes + (quantizer.rotation.nbytes if quantizer.rotation is not None else 0)
+        print("PQ codes: {0:.1f} MB in memory instead of {1:.1f} MB of float descriptors ({2:.1f}x smaller)".format(
+            codes_bytes / 2.0**20, features_dataset.nbytes / 2.0**20, float(features_dataset.nbytes) / codes_bytes))
+    if index_search is not None and args.index_report:
+        start = time.time()
+        _, exact_idx = search(features_queries, features_dataset, 100, memory_budget, args.search_threads)
+        exact_time = time.time() - start
+        start = time.time()
+        approximate_idx = index_search(features_queries, 100)
+        approximate_time = time.time() - start
+        print("{0}: recall@100 {1:.4f}, {2:.1f}x faster than the exhaustive search ({3:.2f}s vs {4:.2f}s)".format(
+            index_name, recall_at_k(approximate_idx, exact_idx), exact_time / approximate_time, approximate_time, exact_time))
+
     # Score
-    dataset.score(features_queries, features_dataset, args.aqe, args.temp_dir)
+    dataset.score(features_queries, features_dataset, args.aqe, args.temp_dir, memory_budget, args.search_threads, index_search)
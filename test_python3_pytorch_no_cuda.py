@@ -6,6 +6,18 @@ from torch.autograd import Variable
 from Common import L2Normalization
 from Common import Shift
 from Common import RoIPool
+from Common import RMACHead
+from Common import configure_cpu_threads
+from Common import prepare_cpu_model
+from Common import pin_cpu_cores
+from Common import shard_cpu_cores
+from Common import shard_ranges
+from Common import compute_in_chunks
+from Common import save_array
+from Common import get_rmac_region_coordinates
+from Common import load_multiscale_features
+from Common import top_k
+from Common import search
 
 import imp
 import sys
@@ -18,6 +30,9 @@ from collections import OrderedDict
 import subprocess
 import pdb
 import re
+import time
+import copy
+import multiprocessing
 
 class ImageHelper:
     def __init__(self, S, L, means):
@@ -34,6 +49,7 @@ class ImageHelper:
         # Load the PCA weights learned with off-the-shelf Resnet101
         self.pca_fc.weight.data = torch.Tensor(np.load('weights/pca_weight.npy'))
         self.pca_fc.bias.data = torch.Tensor(np.load('weights/pca_bias.npy'))
+        self.rmac_head = RMACHead(self.pca_shift, self.pca_fc)
 
     def prepare_image_and_grid_regions_for_network(self, fname, roi=None):
         # Extract image, resize at desired size, and extract roi region if
@@ -62,8 +78,8 @@ class ImageHelper:
         rois = Variable(torch.FloatTensor(R))
         # feature map
         # h = Variable(np.array(net.blobs['res5c'].data)
-        h = net(Variable(torch.from_numpy(I).cuda()))
-        h = h.cpu().data
+        h = net(Variable(torch.from_numpy(I)))
+        h = h.data
         # h =  np.squeeze(net.blobs['res5c'].data)
 
         # R-MAC module
@@ -81,6 +97,17 @@ class ImageHelper:
 
         return g
 
+    def get_rmac_features_cpu(self, I, R, net, bf16=False):
+        # Inference only path for a net from prepare_cpu_model: no autograd,
+        # channels_last input and optionally the backbone autocast to
+        # bfloat16. The R-MAC head always runs in float32.
+        with torch.inference_mode():
+            I = torch.from_numpy(I).contiguous(memory_format=torch.channels_last)
+            with torch.autocast('cpu', dtype=torch.bfloat16, enabled=bf16):
+                h = net(I)
+            g = self.rmac_head(h.float(), torch.from_numpy(R))
+        return g
+
     def load_and_prepare_image(self, fname, roi=None):
         # Read image, get aspect ratio, and resize such as the largest side equals S
         print(fname)
@@ -118,57 +145,7 @@ class ImageHelper:
         return R
 
     def get_rmac_region_coordinates(self, H, W, L):
-        # Almost verbatim from Tolias et al Matlab implementation.
-        # Could be heavily pythonized, but really not worth it...
-        # Desired overlap of neighboring regions
-        ovr = 0.4
-        # Possible regions for the long dimension
-        steps = np.array((2, 3, 4, 5, 6, 7), dtype=np.float32)
-        w = np.minimum(H, W)
-
-        b = (np.maximum(H, W) - w) / (steps - 1)
-        # steps(idx) regions for long dimension. The +1 comes from Matlab
-        # 1-indexing...
-        idx = np.argmin(np.abs(((w**2 - w * b) / w**2) - ovr)) + 1
-
-        # Region overplus per dimension
-        Wd = 0
-        Hd = 0
-        if H < W:
-            Wd = idx
-        elif H > W:
-            Hd = idx
-
-        regions_xywh = []
-        for l in range(1, L+1):
-            wl = np.floor(2 * w / (l + 1))
-            wl2 = np.floor(wl / 2 - 1)
-            # Center coordinates
-            if l + Wd - 1 > 0:
-                b = (W - wl) / (l + Wd - 1)
-            else:
-                b = 0
-            cenW = np.floor(wl2 + b * np.arange(l - 1 + Wd + 1)) - wl2
-            # Center coordinates
-            if l + Hd - 1 > 0:
-                b = (H - wl) / (l + Hd - 1)
-            else:
-                b = 0
-            cenH = np.floor(wl2 + b * np.arange(l - 1 + Hd + 1)) - wl2
-
-            for i_ in cenH:
-                for j_ in cenW:
-                    regions_xywh.append([j_, i_, wl, wl])
-
-        # Round the regions. Careful with the borders!
-        for i in range(len(regions_xywh)):
-            for j in range(4):
-                regions_xywh[i][j] = int(round(regions_xywh[i][j]))
-            if regions_xywh[i][0] + regions_xywh[i][2] > W:
-                regions_xywh[i][0] -= ((regions_xywh[i][0] + regions_xywh[i][2]) - W)
-            if regions_xywh[i][1] + regions_xywh[i][3] > H:
-                regions_xywh[i][1] -= ((regions_xywh[i][1] + regions_xywh[i][3]) - H)
-        return np.array(regions_xywh).astype(np.float32)
+        return get_rmac_region_coordinates(H, W, L)
 
 
 class Dataset:
@@ -203,7 +180,8 @@ class Dataset:
     def score(self, sim, temp_dir):
         if not os.path.exists(temp_dir):
             os.makedirs(temp_dir)
-        idx = np.argsort(sim, axis=1)[:, ::-1]
+        # The .rnk files hold the whole ranking
+        idx = top_k(sim, sim.shape[1])
         ls_top1 = []
         ls_top10 = []
         for i in range(len(self.query_imagenames)):
@@ -277,41 +255,137 @@ class Dataset:
     #     return self.q_roi[self.q_names[i]]
 
 
+def get_features(image_helper, I, R, net, args):
+    if args.cpu_inference:
+        return image_helper.get_rmac_features_cpu(I, R, net, args.bf16).numpy()
+    return image_helper.get_rmac_features(I, R, net).detach().numpy()
+
+
+def warmup(image_helper, I, R, net, args):
+    # The first passes of each input shape pick the mkldnn kernels and
+    # allocate the buffers, they should not be timed
+    for _ in range(args.warmup):
+        get_features(image_helper, I, R, net, args)
+
+
+def benchmark_cpu_inference(dataset, image_helper, net, args):
+    # Compare the autograd path and the inference mode on the same images.
+    # Images are decoded beforehand, only the network and the head are timed.
+    n = min(args.benchmark, dataset.N_images)
+    inputs = [image_helper.prepare_image_and_grid_regions_for_network(dataset.get_filename(i), roi=None) for i in range(n)]
+    runs = [('autograd', net, argparse.Namespace(**dict(vars(args), cpu_inference=False, bf16=False))),
+            ('inference', prepare_cpu_model(copy.deepcopy(net), channels_last=True), argparse.Namespace(**dict(vars(args), cpu_inference=True)))]
+    features = {}
+    for name, model, run_args in runs:
+        warmup(image_helper, inputs[0][0], inputs[0][1], model, run_args)
+        start = time.time()
+        features[name] = np.vstack([get_features(image_helper, I, R, model, run_args) for I, R in inputs])
+        print("{0}: {1:.2f} images/s".format(name, n / (time.time() - start)))
+    diff = np.abs(features['autograd'] - features['inference']).max()
+    print("threads: {0}, bf16: {1}, max descriptor difference: {2:.2e}".format(torch.get_num_threads(), args.bf16, diff))
+
+
+def load_network():
+    MainModel = imp.load_source('MainModel', 'pytorch/pytorch_resnet101.py')
+
+    net = torch.load('pytorch/pytorch_resnet101.pth', map_location='cpu')
+    net.eval()
+    return net
+
+
+def compute_features(image_helper, net, fnames, args, position=0):
+    dim_features = 2048
+    features = np.zeros((len(fnames), dim_features), dtype=np.float32)
+    for i in tqdm(range(len(fnames)), file=sys.stdout, leave=False, dynamic_ncols=True, position=position):
+        # Load image, process image, get image regions, feed into the network, get descriptor, and store
+        I, R = image_helper.prepare_image_and_grid_regions_for_network(fnames[i], roi=None)
+        features[i] = get_features(image_helper, I, R, net, args)
+    return features
+
+
+def extract_shard(args, S, fnames, cores, shard, out_fname, load=None):
+    # Worker process of compute_features_sharded, with its own copy of the
+    # network and its own cores. load(S) returns the (image helper, network)
+    # to use instead of those of the ResNet-101 (e.g. in the benchmarks).
+    pin_cpu_cores(cores)
+    if load is None:
+        net = load_network()
+        image_helper = ImageHelper(S, args.L, args.means)
+    else:
+        image_helper, net = load(S)
+    if args.cpu_inference:
+        net = prepare_cpu_model(net, channels_last=True)
+        I, R = image_helper.prepare_image_and_grid_regions_for_network(fnames[0], roi=None)
+        warmup(image_helper, I, R, net, args)
+    features = compute_features(image_helper, net, fnames, args, position=shard)
+    save_array(out_fname, features)
+
+
+def compute_features_sharded(fnames, S, out_fname, args, load=None):
+    # Splits fnames into args.processes contiguous shards, each extracted by
+    # a worker pinned to its share of the cores into its own file, and
+    # merges them in order. Shards left by an interrupted run are reused.
+    # Workers are spawned rather than forked, the OpenMP pool of this process
+    # does not survive a fork.
+    ranges = shard_ranges(len(fnames), args.processes)
+    cores = shard_cpu_cores(args.processes)
+    shard_fnames = ["{0}.shard{1}of{2}.npy".format(out_fname[:-len('.npy')], k, args.processes) for k in range(args.processes)]
+    context = multiprocessing.get_context('spawn')
+    workers = []
+    for k, (start, end) in enumerate(ranges):
+        if start < end and not os.path.exists(shard_fnames[k]):
+            worker = context.Process(target=extract_shard, args=(args, S, fnames[start:end], cores[k], k, shard_fnames[k], load))
+            worker.start()
+            workers.append(worker)
+    for worker in workers:
+        worker.join()
+    if any(worker.exitcode != 0 for worker in workers):
+        raise RuntimeError("Feature extraction failed in {0} of {1} workers".format(sum(worker.exitcode != 0 for worker in workers), len(workers)))
+
+    # Shards are only removed once all of them have been read
+    shards = [(start, end, shard_fname) for (start, end), shard_fname in zip(ranges, shard_fnames) if start < end]
+    features = np.zeros((len(fnames), 2048), dtype=np.float32)
+    for start, end, shard_fname in shards:
+        features[start:end] = np.load(shard_fname)
+    for _, _, shard_fname in shards:
+        os.remove(shard_fname)
+    return features
+
+
+def get_scales(args):
+    return [args.S, ] if not args.multires else [args.S - 250, args.S, args.S + 250]
+
+
+def get_features_fname(args, S, part):
+    return "{0}/{1}_S{2}_L{3}_{4}.npy".format(args.temp_dir, args.dataset_name, S, args.L, part)
+
+
 def extract_features(dataset, image_helper, net, args):
-    Ss = [args.S, ] if not args.multires else [args.S - 250, args.S, args.S + 250]
+    Ss = get_scales(args)
     # First part, queries
     for S in Ss:
         # Set the scale of the image helper
         image_helper.S = S
-        out_queries_fname = "{0}/{1}_S{2}_L{3}_queries.npy".format(args.temp_dir, args.dataset_name, S, args.L)
+        out_queries_fname = get_features_fname(args, S, 'queries')
         if not os.path.exists(out_queries_fname):
-            dim_features = 2048
-            N_queries = dataset.N_queries
-            features_queries = np.zeros((N_queries, dim_features), dtype=np.float32)
-            for i in tqdm(range(N_queries), file=sys.stdout, leave=False, dynamic_ncols=True):
-                # Load image, process image, get image regions, feed into the network, get descriptor, and store
-                I, R = image_helper.prepare_image_and_grid_regions_for_network(dataset.get_query_filename(i), roi=None)
-                features_queries[i] = image_helper.get_rmac_features(I, R, net).detach().numpy()
-            np.save(out_queries_fname, features_queries)
-    features_queries = np.dstack([np.load("{0}/{1}_S{2}_L{3}_queries.npy".format(args.temp_dir, args.dataset_name, S, args.L)) for S in Ss]).sum(axis=2)
-    features_queries /= np.sqrt((features_queries * features_queries).sum(axis=1))[:, None]
+            fnames = [dataset.get_query_filename(i) for i in range(dataset.N_queries)]
+            compute_in_chunks(lambda start, end: compute_features(image_helper, net, fnames[start:end], args),
+                              len(fnames), out_queries_fname, args.chunk_size)
+    features_queries = load_multiscale_features([get_features_fname(args, S, 'queries') for S in Ss])
 
     # Second part, dataset
     for S in Ss:
         image_helper.S = S
-        out_dataset_fname = "{0}/{1}_S{2}_L{3}_dataset.npy".format(args.temp_dir, args.dataset_name, S, args.L)
+        out_dataset_fname = get_features_fname(args, S, 'dataset')
         if not os.path.exists(out_dataset_fname):
             # dim_features = net.blobs['rmac/normalized'].data.shape[1]
-            dim_features = 2048
-            N_dataset = dataset.N_images
-            features_dataset = np.zeros((N_dataset, dim_features), dtype=np.float32)
-            for i in tqdm(range(N_dataset), file=sys.stdout, leave=False, dynamic_ncols=True):
-                # Load image, process image, get image regions, feed into the network, get descriptor, and store
-                I, R = image_helper.prepare_image_and_grid_regions_for_network(dataset.get_filename(i), roi=None)
-                features_dataset[i] = image_helper.get_rmac_features(I, R, net).detach().numpy()
-            np.save(out_dataset_fname, features_dataset)
-    features_dataset = np.dstack([np.load("{0}/{1}_S{2}_L{3}_dataset.npy".format(args.temp_dir, args.dataset_name, S, args.L)) for S in Ss]).sum(axis=2)
-    features_dataset /= np.sqrt((features_dataset * features_dataset).sum(axis=1))[:, None]
+            fnames = [dataset.get_filename(i) for i in range(dataset.N_images)]
+            if args.processes > 1:
+                save_array(out_dataset_fname, compute_features_sharded(fnames, S, out_dataset_fname, args))
+            else:
+                compute_in_chunks(lambda start, end: compute_features(image_helper, net, fnames[start:end], args),
+                                  len(fnames), out_dataset_fname, args.chunk_size)
+    features_dataset = load_multiscale_features([get_features_fname(args, S, 'dataset') for S in Ss])
     # Restore the original scale
     image_helper.S = args.S
     return features_queries, features_dataset
@@ -331,8 +405,19 @@ if __name__ == '__main__':
     parser.add_argument('--multires', dest='multires', action='store_true', help='Enable multiresolution features')
     parser.add_argument('--aqe', type=int, required=False, help='Average query expansion with k neighbors')
     parser.add_argument('--dbe', type=int, required=False, help='Database expansion with k neighbors')
-    parser.set_defaults(multires=False)
+    parser.add_argument('--search_memory', type=float, default=1, help='Memory in GB of the tiles of similarities of the nearest neighbor searches')
+    parser.add_argument('--search_threads', type=int, default=1, help='Search the database in this many shards in parallel, each thread with its share of the intra-op threads')
+    parser.add_argument('--cpu_inference', dest='cpu_inference', action='store_true', help='Run the network under inference mode with channels_last inputs')
+    parser.add_argument('--bf16', dest='bf16', action='store_true', help='With --cpu_inference, autocast the backbone to bfloat16')
+    parser.add_argument('--threads', type=int, required=False, help='Number of intra-op threads')
+    parser.add_argument('--interop_threads', type=int, required=False, help='Number of inter-op threads')
+    parser.add_argument('--warmup', type=int, default=2, help='Number of untimed passes before extraction')
+    parser.add_argument('--benchmark', type=int, required=False, help='Only compare images/s of the autograd and inference paths on this many images')
+    parser.add_argument('--chunk_size', type=int, default=10000, help='Save the features every this many images, an interrupted extraction resumes from the last chunk (0: only at the end)')
+    parser.add_argument('--processes', type=int, default=1, help='Extract the database features in this many processes, each on its share of the cores')
+    parser.set_defaults(multires=False, cpu_inference=False, bf16=False)
     args = parser.parse_args()
+    configure_cpu_threads(args.threads, args.interop_threads)
 
     if not os.path.exists(args.temp_dir):
         os.makedirs(args.temp_dir)
@@ -344,28 +429,37 @@ if __name__ == '__main__':
     index_path = '/ocean/malan/image_retrieve/datasets/house/hx_data'
     query_path = '/ocean/malan/image_retrieve/datasets/house/test'
 
-    MainModel = imp.load_source('MainModel', 'pytorch/pytorch_resnet101.py')
-
-    net = torch.load('pytorch/pytorch_resnet101.pth')
-    net.eval()
-    net = net.cuda()
+    # With --processes, the network of this process only extracts the
+    # queries, each worker loads its own for the database. It is not loaded
+    # when the features of the queries are already there.
+    queries_done = all(os.path.exists(get_features_fname(args, S, 'queries')) for S in get_scales(args))
+    net = None if args.processes > 1 and queries_done and not args.benchmark else load_network()
 
     pdb.set_trace()
     # Load the dataset and the image helper
     dataset = Dataset(index_path, query_path)
     image_helper = ImageHelper(args.S, args.L, args.means)
 
+    if args.benchmark:
+        benchmark_cpu_inference(dataset, image_helper, net, args)
+        sys.exit(0)
+    if args.cpu_inference and net is not None:
+        net = prepare_cpu_model(net, channels_last=True)
+        # With --processes, this network only extracts the queries: each
+        # worker warms up its own copy for the database
+        if args.processes <= 1:
+            I, R = image_helper.prepare_image_and_grid_regions_for_network(dataset.get_filename(0), roi=None)
+            warmup(image_helper, I, R, net, args)
+
     # Extract features
     features_queries, features_dataset = extract_features(dataset, image_helper, net, args)
 
     # Database side expansion?
     if args.dbe is not None and args.dbe > 0:
         # Extend the database features
-        # With larger datasets this has to be done in a batched way.
-        # and using smarter ways than sorting to take the top k results.
-        # For 5k images, not really a problem to do it by brute force
-        X = features_dataset.dot(features_dataset.T)
-        idx = np.argsort(X, axis=1)[:, ::-1]
+        # The neighbors are searched by tiles of the similarity matrix of at
+        # most --search_memory
+        _, idx = search(features_dataset, features_dataset, args.dbe + 1, int(args.search_memory * 2**30), args.search_threads)
         weights = np.hstack(([1], (args.dbe - np.arange(0, args.dbe)) / float(args.dbe)))
         weights_sum = weights.sum()
         features_dataset = np.vstack([np.dot(weights, features_dataset[idx[i, :args.dbe + 1], :]) / weights_sum for i in range(len(features_dataset))])
@@ -378,7 +472,7 @@ if __name__ == '__main__':
         # representations, and query again.
         # No need to L2-normalize as we are on the query side, so it doesn't
         # affect the ranking
-        idx = np.argsort(sim, axis=1)[:, ::-1]
+        idx = top_k(sim, args.aqe)
         features_queries = np.vstack([np.vstack((features_queries[i], features_dataset[idx[i, :args.aqe]])).mean(axis=0) for i in range(len(features_queries))])
         #for i in range(features_queries.shape[0]):
         #    features_queries[i] = np.vstack((features_queries[i], features_dataset[idx[i, :args.aqe]])).mean(axis=0)